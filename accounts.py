@@ -0,0 +1,267 @@
+"""Account deletion for Warbler.
+
+Deleting a busy account in one request means removing years of messages,
+likes and follows (and fixing up everyone else's counters) while holding
+locks on all of it. Instead, `delete_account` only marks the user deleted,
+which takes effect right away (they can't log in, and their profile pages
+404), and queues a job. Other sessions of theirs are dropped once other
+processes' user caches expire (USER_CACHE_TTL). Workers then remove the
+account's rows in batches of at most ACCOUNT_DELETE_BATCH_SIZE, one batch
+per job, in this order:
+
+- likes of the user's messages
+- likes by the user
+- follows to and from the user
+- timeline entries of the user's messages, and the user's own timeline
+- the user's messages
+
+and finally the user row. Other users' counters are adjusted as their
+rows go. New likes of the user's messages are refused, and the likes
+foreign keys cascade, so a like that slips in anyway can't block the
+deletion (its liker's count is still corrected).
+
+Each batch is logged with the running totals by step, which the next
+queued job also carries in its payload. Accounts waiting to be deleted are
+counted at /metrics.
+"""
+
+import logging
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, func, or_, select, tuple_
+
+import jobs
+from instrumentation import metrics
+from models import db, Follow, Like, Message, TimelineEntry, User
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def delete_account(user):
+    """Mark `user` deleted and queue the removal of their data.
+
+    The caller commits.
+    """
+
+    user.deleted_at = datetime.utcnow()
+
+    jobs.enqueue('accounts.delete', {'user_id': user.id},
+                 key=f"accounts.delete:{user.id}")
+
+
+def _delete_rows(model, columns, rows):
+    """Delete the rows of `model` whose `columns` match one of `rows`."""
+
+    db.session.execute(
+        delete(model)
+        .where(tuple_(*columns).in_([tuple(row) for row in rows]))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def _uncount_likes(rows):
+    """Take deleted likes (rows with a `user_id`) off their likers'
+    counts."""
+
+    # Someone may have liked several of the messages
+    likers = Counter(row.user_id for row in rows)
+    for count in set(likers.values()):
+        User.adjust_counts(
+            [liker for liker, n in likers.items() if n == count],
+            likes_count=-count)
+
+
+def _delete_likes_received(user_id, limit):
+    """Delete up to `limit` likes of the user's messages."""
+
+    rows = db.session.execute(
+        select(Like.message_id, Like.user_id)
+        .join(Message, Message.id == Like.message_id)
+        .where(Message.user_id == user_id)
+        .limit(limit)
+    ).all()
+
+    if rows:
+        _delete_rows(Like, (Like.message_id, Like.user_id), rows)
+        _uncount_likes(rows)
+
+    return len(rows)
+
+
+def _delete_likes_given(user_id, limit):
+    """Delete up to `limit` likes by the user."""
+
+    rows = db.session.execute(
+        select(Like.message_id, Like.user_id)
+        .where(Like.user_id == user_id)
+        .limit(limit)
+    ).all()
+
+    if rows:
+        _delete_rows(Like, (Like.message_id, Like.user_id), rows)
+
+    return len(rows)
+
+
+def _delete_follows(user_id, limit):
+    """Delete up to `limit` follows to or from the user."""
+
+    rows = db.session.execute(
+        select(Follow.user_being_followed_id, Follow.user_following_id)
+        .where(or_(Follow.user_being_followed_id == user_id,
+                   Follow.user_following_id == user_id))
+        .limit(limit)
+    ).all()
+
+    if rows:
+        _delete_rows(
+            Follow,
+            (Follow.user_being_followed_id, Follow.user_following_id),
+            rows)
+
+        followed = [row.user_being_followed_id for row in rows
+                    if row.user_following_id == user_id]
+        followers = [row.user_following_id for row in rows
+                     if row.user_being_followed_id == user_id]
+
+        if followed:
+            User.adjust_counts(followed, followers_count=-1)
+        if followers:
+            User.adjust_counts(followers, following_count=-1)
+
+    return len(rows)
+
+
+def _delete_timeline_entries(user_id, limit):
+    """Delete up to `limit` timeline entries of the user's messages or in
+    the user's timeline."""
+
+    rows = db.session.execute(
+        select(TimelineEntry.user_id, TimelineEntry.message_id)
+        .where(or_(TimelineEntry.user_id == user_id,
+                   TimelineEntry.message_id.in_(
+                       select(Message.id)
+                       .where(Message.user_id == user_id))))
+        .limit(limit)
+    ).all()
+
+    if rows:
+        _delete_rows(
+            TimelineEntry,
+            (TimelineEntry.user_id, TimelineEntry.message_id),
+            rows)
+
+    return len(rows)
+
+
+def _delete_messages(user_id, limit):
+    """Delete up to `limit` of the user's messages.
+
+    Likes are rejected once an account is being deleted, but one that
+    raced in after the likes step would be removed by the foreign key's
+    cascade, so it's taken off its liker's count here.
+    """
+
+    message_ids = db.session.scalars(
+        select(Message.id).where(Message.user_id == user_id).limit(limit)
+    ).all()
+
+    if message_ids:
+        _uncount_likes(db.session.execute(
+            select(Like.user_id).where(Like.message_id.in_(message_ids))
+        ).all())
+
+        db.session.execute(
+            delete(Message)
+            .where(Message.id.in_(message_ids))
+            .execution_options(synchronize_session=False)
+        )
+
+    return len(message_ids)
+
+
+# (name, function of (user id, limit) returning the number of rows
+# deleted), in the order they run.
+STEPS = [
+    ('likes_received', _delete_likes_received),
+    ('likes_given', _delete_likes_given),
+    ('follows', _delete_follows),
+    ('timeline_entries', _delete_timeline_entries),
+    ('messages', _delete_messages),
+]
+
+
+@jobs.task('accounts.delete')
+def delete_account_job(payload):
+    """Delete the next batch of a deleted account's rows, and queue
+    another job for the rest; or, once nothing is left, the user row.
+
+    The payload has the `user_id`, and on later jobs the `step` to carry on
+    from and the rows `deleted` so far by step.
+    """
+
+    user_id = payload['user_id']
+    deleted = dict(payload.get('deleted', {}))
+    batch_size = current_app.config.get(
+        'ACCOUNT_DELETE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+    deleted_at = db.session.scalar(
+        select(User.deleted_at).where(User.id == user_id))
+
+    if deleted_at is None:
+        return
+
+    names = [name for name, _ in STEPS]
+    start = names.index(payload.get('step', names[0]))
+
+    for index, (name, delete_batch) in enumerate(STEPS[start:], start):
+        count = delete_batch(user_id, batch_size)
+
+        if not count:
+            continue
+
+        deleted[name] = deleted.get(name, 0) + count
+        logger.info("Deleting account %s: %s so far", user_id, deleted)
+
+        # A full batch may have left more behind; otherwise move on.
+        if count < batch_size:
+            index += 1
+
+        if index < len(STEPS):
+            jobs.enqueue('accounts.delete', {
+                'user_id': user_id,
+                'step': names[index],
+                'deleted': deleted,
+            })
+            return
+
+    db.session.execute(
+        delete(User)
+        .where(User.id == user_id)
+        .execution_options(synchronize_session=False)
+    )
+    logger.info("Deleted account %s: %s", user_id, deleted)
+
+
+def deletion_metrics():
+    """Metrics collector counting accounts waiting to be deleted."""
+
+    pending = db.session.scalar(
+        select(func.count(User.id)).where(User.deleted_at.isnot(None)))
+
+    return [
+        ('warbler_account_deletions_pending', 'gauge',
+         "Deleted accounts whose data hasn't all been removed yet.",
+         [({}, pending)]),
+    ]
+
+
+def init_app(app):
+    """Serve account deletion metrics for `app`."""
+
+    if deletion_metrics not in metrics.collectors:
+        metrics.add_collector(deletion_metrics)
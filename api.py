@@ -0,0 +1,255 @@
+"""JSON API for Warbler, for clients that don't want HTML pages.
+
+Endpoints live under /api/v1 and use the same session login as the site.
+They run the same queries as the HTML views, but select only the columns
+they return, and encode responses with orjson.
+
+Lists are paged like the site: each response has a `next_cursor`, passed
+back as `?before=` to get the next page (null on the last page).
+
+Requests that change something must send a JSON body (even just `{}`),
+with Content-Type: application/json. Browsers won't send that cross-site
+without CORS approval, so other sites can't forge them with the user's
+cookie.
+"""
+
+import orjson
+from flask import Blueprint, Response, g, request
+from sqlalchemy import select
+from werkzeug.exceptions import (
+    BadRequest, HTTPException, NotFound, Unauthorized, UnsupportedMediaType)
+
+from models import db, Like, Message, User
+from pagination import (
+    decode_message_cursor, like_key, make_page, message_key)
+from replicas import read_only
+import timelines
+
+MESSAGES_PER_PAGE = 50
+
+# What's returned for each message and user.
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    User.username,
+    User.image_url,
+)
+
+PROFILE_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.following_count,
+    User.followers_count,
+    User.likes_count,
+)
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+def _json(data, status=200):
+    """Return `data` as a JSON response."""
+
+    return Response(orjson.dumps(data), status=status,
+                    mimetype='application/json')
+
+
+@bp.errorhandler(HTTPException)
+def handle_http_error(error):
+    """Report errors as JSON rather than HTML pages."""
+
+    return _json({'error': error.description}, error.code)
+
+
+@bp.before_request
+def check_request():
+    """Require a login, and a JSON body on anything that changes data."""
+
+    if not g.user:
+        raise Unauthorized("Log in first.")
+
+    if request.method == 'POST' and not request.is_json:
+        raise UnsupportedMediaType("Send a JSON body.")
+
+
+def _require_user(user_id):
+    """Raise 404 unless user `user_id` exists and isn't being deleted."""
+
+    db.first_or_404(select(User.id)
+                    .where(User.id == user_id)
+                    .where(User.deleted_at.is_(None)))
+
+
+def _message(row, liked_ids):
+    """JSON-ready dict for a row of MESSAGE_COLUMNS."""
+
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp,
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+        'liked': row.id in liked_ids,
+    }
+
+
+def _messages_response(rows, page_size, key=message_key):
+    """JSON response for a page of messages, from up to `page_size + 1`
+    rows of MESSAGE_COLUMNS, paged by `key`."""
+
+    page = make_page(rows, page_size, key)
+    liked_ids = g.user.liked_ids_among([row.id for row in page.items])
+
+    return _json({
+        'messages': [_message(row, liked_ids) for row in page.items],
+        'next_cursor': page.next_cursor,
+    })
+
+
+def _message_page(query, key=message_key, key_columns=()):
+    """JSON response for a page of `query`, which selects messages in `key`
+    order and joins their users. Only MESSAGE_COLUMNS, and any
+    `key_columns` that `key` needs, are loaded."""
+
+    rows = db.session.execute(
+        query.with_only_columns(*MESSAGE_COLUMNS, *key_columns,
+                                maintain_column_froms=True)
+        .limit(MESSAGES_PER_PAGE + 1)
+    ).all()
+
+    return _messages_response(rows, MESSAGES_PER_PAGE, key)
+
+
+@bp.get('/timeline')
+@read_only
+def timeline():
+    """The logged-in user's home timeline."""
+
+    before = decode_message_cursor(request.args.get('before'))
+    message_ids = timelines.home_timeline_ids(
+        g.user.id, limit=timelines.TIMELINE_LENGTH + 1, before=before)
+
+    rows = []
+    if message_ids:
+        by_id = {
+            row.id: row
+            for row in db.session.execute(
+                select(*MESSAGE_COLUMNS)
+                .join_from(Message, User, Message.user_id == User.id)
+                .where(Message.id.in_(message_ids))
+                .where(User.deleted_at.is_(None)))
+        }
+        rows = [by_id[message_id] for message_id in message_ids
+                if message_id in by_id]
+
+    return _messages_response(rows, timelines.TIMELINE_LENGTH)
+
+
+@bp.get('/users/<int:user_id>')
+@read_only
+def show_user(user_id):
+    """A user's profile."""
+
+    user = db.session.execute(
+        select(*PROFILE_COLUMNS)
+        .where(User.id == user_id)
+        .where(User.deleted_at.is_(None))).first()
+
+    if user is None:
+        raise NotFound("No such user.")
+
+    profile = user._asdict()
+    profile['following'] = bool(g.user.following_ids_among([user.id]))
+
+    return _json(profile)
+
+
+@bp.get('/users/<int:user_id>/messages')
+@read_only
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    _require_user(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    return _message_page(
+        Message.newest_by(user_id, before).join(Message.user))
+
+
+@bp.get('/users/<int:user_id>/likes')
+@read_only
+def user_likes(user_id):
+    """Messages a user has liked, most recently liked first."""
+
+    _require_user(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    return _message_page(
+        Message.liked_by(user_id, before),
+        key=like_key,
+        key_columns=(Like.created_at.label('liked_at'), Like.message_id))
+
+
+@bp.post('/users/<int:user_id>/follow')
+def follow(user_id):
+    """Follow a user. Following someone already followed is a no-op."""
+
+    if user_id == g.user.id:
+        raise BadRequest("You can't follow yourself.")
+
+    user = User.get_active_or_404(user_id)
+
+    if g.user.follow(user):
+        timelines.queue_add_author(g.user.id, user.id)
+    db.session.commit()
+
+    return _json({'following': True})
+
+
+@bp.post('/users/<int:user_id>/unfollow')
+def unfollow(user_id):
+    """Stop following a user."""
+
+    user = User.get_active_or_404(user_id)
+
+    if g.user.unfollow(user):
+        timelines.remove_author(g.user.id, user.id)
+    db.session.commit()
+
+    return _json({'following': False})
+
+
+@bp.post('/messages/<int:message_id>/like')
+def like(message_id):
+    """Like a message. Liking it again is a no-op."""
+
+    message = Message.get_active_or_404(message_id)
+
+    if message.user_id == g.user.id:
+        raise BadRequest("You can't like your own message.")
+
+    g.user.like(message)
+    db.session.commit()
+
+    return _json({'liked': True})
+
+
+@bp.post('/messages/<int:message_id>/unlike')
+def unlike(message_id):
+    """Unlike a message."""
+
+    message = Message.get_active_or_404(message_id)
+
+    g.user.unlike(message)
+    db.session.commit()
+
+    return _json({'liked': False})
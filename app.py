@@ -1,16 +1,52 @@
 import os
+import click
 from dotenv import load_dotenv
 from werkzeug.exceptions import Unauthorized
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, render_template, stream_template, request, flash, redirect,
+    session, g, get_flashed_messages)
 from flask_debugtoolbar import DebugToolbarExtension
+from flask_migrate import Migrate
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import select
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.exc import IntegrityError
 
+from hashing import hasher
 from forms import UserAddForm, LoginForm, MessageForm, CSRFProtectForm, EditProfileForm
-from models import db, connect_db, User, Message, DEFAULT_IMAGE_URL
+from models import db, connect_db, User, Message, Like, DEFAULT_IMAGE_URL
+import accounts
+import api
+import bulk_load
+import fragments
+import http_cache
+import instrumentation
+import jobs
+import pooling
+import replicas
+import search
+import static_assets
+import user_cache
+from pagination import (
+    Page, decode_id_cursor, decode_message_cursor, decode_rank_cursor,
+    like_key, make_page, message_key, user_key)
+from replicas import read_only
+import timelines
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
+MESSAGES_PER_PAGE = 50
+USERS_PER_PAGE = 48
+
+# What follower/following cards show.
+USER_CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+)
+
 
 app = Flask(__name__)
 
@@ -18,9 +54,69 @@ app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+app.config['TIMELINE_FANOUT_THRESHOLD'] = int(
+    os.environ.get('TIMELINE_FANOUT_THRESHOLD', 10000))
+app.config['TIMELINE_MAX_ENTRIES'] = int(
+    os.environ.get('TIMELINE_MAX_ENTRIES', 1000))
+app.config['TIMELINE_TRIM_INTERVAL'] = int(
+    os.environ.get('TIMELINE_TRIM_INTERVAL', 100))
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(
+    os.environ.get('SLOW_QUERY_THRESHOLD_MS', 100))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 1024))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['HASHING_POOL_SIZE'] = int(os.environ.get('HASHING_POOL_SIZE', 2))
+app.config['HASHING_QUEUE_SIZE'] = int(
+    os.environ.get('HASHING_QUEUE_SIZE', 16))
+app.config['HASHING_QUEUE_TIMEOUT'] = float(
+    os.environ.get('HASHING_QUEUE_TIMEOUT', 1))
+app.config['USER_SEARCH_FIELDS'] = tuple(
+    os.environ.get('USER_SEARCH_FIELDS', 'username').split(','))
+app.config['USER_SEARCH_TIMEOUT_MS'] = int(
+    os.environ.get('USER_SEARCH_TIMEOUT_MS', 500))
+app.config['DATABASE_REPLICA_URLS'] = [
+    url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+    if url]
+app.config['READ_YOUR_WRITES_SECONDS'] = float(
+    os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+app.config['DB_POOL_PRE_PING'] = (
+    os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true')
+app.config['DB_STATEMENT_TIMEOUT_MS'] = int(
+    os.environ.get('DB_STATEMENT_TIMEOUT_MS', 0))
+app.config['DB_PGBOUNCER'] = (
+    os.environ.get('DB_PGBOUNCER', 'false').lower() == 'true')
+app.config['FRAGMENT_CACHE_SIZE'] = int(
+    os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['FRAGMENT_CACHE_URL'] = os.environ.get('FRAGMENT_CACHE_URL')
+app.config['FRAGMENT_CACHE_TTL'] = int(
+    os.environ.get('FRAGMENT_CACHE_TTL', 24 * 60 * 60))
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+app.config['JOB_RETENTION_SECONDS'] = int(
+    os.environ.get('JOB_RETENTION_SECONDS', 24 * 60 * 60))
+app.config['ACCOUNT_DELETE_BATCH_SIZE'] = int(
+    os.environ.get('ACCOUNT_DELETE_BATCH_SIZE', 1000))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = pooling.engine_options(app.config)
 toolbar = DebugToolbarExtension(app)
 
+replicas.init_app(app)
+instrumentation.init_app(app)
+user_cache.configure(app)
+fragments.init_app(app)
+http_cache.init_app(app)
+static_assets.init_app(app)
+hasher.init_app(app)
+
 connect_db(app)
+pooling.init_app(app, db.engines.values())
+jobs.init_app(app)
+accounts.init_app(app)
+migrate = Migrate(app, db)
+app.register_blueprint(api.bp)
 
 
 ##############################################################################
@@ -29,13 +125,13 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    The user is only loaded (usually from the user cache) the first time
+    a view or template reads `g.user`.
+    """
 
-    else:
-        g.user = None
+    user_cache.reset_current_user(CURR_USER_KEY)
 
 @app.before_request
 def add_csrf_to_g():
@@ -56,6 +152,20 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def stream_page(template, **context):
+    """Render `template` as a streamed response, sent as it renders.
+
+    The session cookie goes out before the body, so the CSRF token and
+    flashed messages (which change the session) are taken up front. Run
+    any queries the template needs before calling this, too.
+    """
+
+    generate_csrf()
+    get_flashed_messages()
+
+    return stream_template(template, **context)
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -117,6 +227,8 @@ def login():
         )
 
         if user:
+            # Saves the password if authenticate() upgraded its hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -150,59 +262,133 @@ def logout():
 # General user routes:
 
 @app.get('/users')
+@read_only
 def list_users():
-    """Page with listing of users.
+    """Page with listing of users, newest first.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, which
+    shows the best matches, or a 'before' cursor to load the next page.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    search = request.args.get('q')
+    term = request.args.get('q')
+
+    if term:
+        page = Page(search.search_users(term, limit=USERS_PER_PAGE), None)
 
-    if not search:
-        users = User.query.all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-    return render_template('users/index.html', users=users)
+        before = decode_id_cursor(request.args.get('before'))
+        query = (User.query
+                 .filter(User.deleted_at.is_(None))
+                 .order_by(User.id.desc()))
+
+        if before:
+            query = query.filter(User.id < before)
+
+        page = make_page(query.limit(USERS_PER_PAGE + 1).all(),
+                         USERS_PER_PAGE, user_key)
+
+    following_ids = g.user.following_ids_among([u.id for u in page.items])
+
+    return render_template(
+        'users/index.html',
+        users=page.items,
+        following_ids=following_ids,
+        next_cursor=page.next_cursor)
 
 
 @app.get('/users/<int:user_id>')
+@read_only
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile with a page of their messages, newest first."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/show.html', user=user)
+    user = User.get_active_or_404(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    messages = db.session.scalars(
+        Message.newest_by(user.id, before).limit(MESSAGES_PER_PAGE + 1)
+    ).all()
+    page = make_page(messages, MESSAGES_PER_PAGE, message_key)
+
+    liked_ids = g.user.liked_ids_among([m.id for m in page.items])
+    is_following = g.user.is_following(user)
+
+    tag = http_cache.etag(
+        user.id,
+        user.profile_version,
+        user.messages_count,
+        user.following_count,
+        user.followers_count,
+        user.likes_count,
+        [m.id for m in page.items],
+        page.next_cursor,
+        sorted(liked_ids),
+        is_following)
+
+    return http_cache.conditional(tag, lambda: render_template(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        liked_ids=liked_ids,
+        is_following=is_following,
+        next_cursor=page.next_cursor))
 
 
 @app.get('/users/<int:user_id>/following')
+@read_only
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show a page of the people this user is following."""
 
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return show_follows(user_id, User.followed_by, 'users/following.html')
 
 
 @app.get('/users/<int:user_id>/followers')
+@read_only
 def show_followers(user_id):
-    """Show list of followers of this user."""
+    """Show a page of this user's followers."""
+
+    return show_follows(user_id, User.followers_of, 'users/followers.html')
+
+
+def show_follows(user_id, select_users, template):
+    """Stream a page of the users `select_users` picks for `user_id`,
+    highest id first, as cards with follow buttons.
+
+    Only USER_CARD_COLUMNS are loaded. The viewer's follow state for every
+    card (and the profile itself) is looked up in one query.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    before = decode_id_cursor(request.args.get('before'))
+
+    rows = db.session.execute(
+        select_users(user.id, before)
+        .with_only_columns(*USER_CARD_COLUMNS, maintain_column_froms=True)
+        .limit(USERS_PER_PAGE + 1)
+    ).all()
+    page = make_page(rows, USERS_PER_PAGE, user_key)
+
+    following_ids = g.user.following_ids_among(
+        [row.id for row in page.items] + [user.id])
+
+    return stream_page(
+        template,
+        user=user,
+        users=page.items,
+        following_ids=following_ids,
+        is_following=user.id in following_ids,
+        next_cursor=page.next_cursor)
 
 
 @app.post('/users/follow/<int:follow_id>')
@@ -217,8 +403,9 @@ def start_following(follow_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        followed_user = User.query.get_or_404(follow_id)
-        g.user.following.append(followed_user)
+        followed_user = User.get_active_or_404(follow_id)
+        if g.user.follow(followed_user):
+            timelines.queue_add_author(g.user.id, followed_user.id)
         db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -235,8 +422,9 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.get_active_or_404(follow_id)
+    if g.user.unfollow(followed_user):
+        timelines.remove_author(g.user.id, followed_user.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -264,8 +452,10 @@ def profile():
             g.user.location = form.location.data
             g.user.bio = form.bio.data
             g.user.header_image_url = form.header_image_url.data
+            g.user.bump_profile_version()
 
             db.session.commit()
+            user_cache.invalidate(g.user.id)
 
             return redirect(f"/users/{g.user.id}")
         else:
@@ -278,6 +468,9 @@ def profile():
 def delete_user():
     """Delete user.
 
+    The account is closed right away; its data is removed by background
+    jobs (see accounts.py).
+
     Redirect to signup page.
     """
 
@@ -286,10 +479,10 @@ def delete_user():
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        Message.query.filter(Message.user_id == g.user.id).delete()
-
-        db.session.delete(g.user)
+        user_id = g.user.id
+        accounts.delete_account(g.user)
         db.session.commit()
+        user_cache.invalidate(user_id)
 
         do_logout()
 
@@ -316,6 +509,9 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        timelines.queue_fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -323,7 +519,35 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
+@app.get('/messages/search')
+@read_only
+def search_messages():
+    """Search message text.
+
+    Takes a 'q' param in querystring, and a 'before' cursor to load the
+    next page of results.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    term = request.args.get('q', '')
+    before = decode_rank_cursor(request.args.get('before'))
+
+    page = search.search_messages(term, MESSAGES_PER_PAGE, before)
+    liked_ids = g.user.liked_ids_among([m.id for m in page.items])
+
+    return render_template(
+        'messages/search.html',
+        term=term,
+        messages=page.items,
+        liked_ids=liked_ids,
+        next_cursor=page.next_cursor)
+
+
 @app.get('/messages/<int:message_id>')
+@read_only
 def show_message(message_id):
     """Show a message."""
 
@@ -331,8 +555,26 @@ def show_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = Message.get_active_or_404(message_id)
+    liked_ids = g.user.liked_ids_among([msg.id])
+    is_author = g.user.id == msg.user_id
+    is_following = not is_author and g.user.is_following(msg.user)
+
+    # Messages can't be edited, so only their author's profile and the
+    # viewer's state change what's shown
+    tag = http_cache.etag(
+        msg.id,
+        msg.user.profile_version,
+        msg.id in liked_ids,
+        is_author,
+        is_following)
+
+    return http_cache.conditional(tag, lambda: render_template(
+        'messages/show.html',
+        message=msg,
+        liked_ids=liked_ids,
+        is_author=is_author,
+        is_following=is_following))
 
 
 @app.route('/messages/<int:message_id>/delete', methods =["GET", "POST"])
@@ -342,7 +584,7 @@ def delete_message(message_id):
     Check that this message was written by the current user.
     Redirect to user page on success.
     """
-    message = Message.query.get_or_404(message_id)
+    message = Message.get_active_or_404(message_id)
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -353,8 +595,14 @@ def delete_message(message_id):
 
 
     if g.csrf_form.validate_on_submit():
-        msg = Message.query.get_or_404(message_id)
-        db.session.delete(msg)
+        timelines.remove_message(message.id)
+
+        likers = select(Like.user_id).where(Like.message_id == message.id)
+        User.adjust_counts(likers, likes_count=-1)
+        Like.query.filter(Like.message_id == message.id).delete()
+
+        User.adjust_counts(g.user.id, messages_count=-1)
+        db.session.delete(message)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -372,30 +620,49 @@ def like_unlike_message(message_id):
         return redirect("/")
 
     if g.csrf_form.validate_on_submit():
-        message = Message.query.get_or_404(message_id)
+        message = Message.get_active_or_404(message_id)
 
         if message.user_id == g.user.id:
             return redirect(f"/users/{g.user.id}")
 
-        if message not in g.user.like_messages:
-            g.user.like_messages.append(message)
-            db.session.commit()
-            return redirect(request.referrer)
+        if not g.user.like(message):
+            g.user.unlike(message)
 
-        else:
-            g.user.like_messages.remove(message)
-            db.session.commit()
-            return redirect(request.referrer)
+        db.session.commit()
+        return redirect(request.referrer)
     else:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
 
 @app.get('/users/<int:user_id>/likes')
+@read_only
 def show_user_liked_mesages(user_id):
     """ Render template to show list of users liked messages"""
 
-    return render_template('/users/likes.html')
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = User.get_active_or_404(user_id)
+    before = decode_message_cursor(request.args.get('before'))
+
+    rows = db.session.execute(
+        Message.liked_by(user.id, before)
+        .options(contains_eager(Message.user))
+        .limit(MESSAGES_PER_PAGE + 1)
+    ).all()
+    page = make_page(rows, MESSAGES_PER_PAGE, like_key)
+    messages = [row.Message for row in page.items]
+
+    liked_ids = g.user.liked_ids_among([m.id for m in messages])
+
+    return render_template(
+        '/users/likes.html',
+        user=user,
+        messages=messages,
+        liked_ids=liked_ids,
+        next_cursor=page.next_cursor)
 
 
 
@@ -404,34 +671,96 @@ def show_user_liked_mesages(user_id):
 
 
 @app.get('/')
+@read_only
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of self & followed_users
+    - logged in: 100 most recent messages of self & followed_users, with
+      a 'before' cursor to load older ones
     """
 
     if g.user:
-        following_users_ids = [ u.id for u in g.user.following ]
-        following_users_ids.append(g.user.id)
-        messages = (Message
-                    .query.filter(Message.user_id.in_(following_users_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before = decode_message_cursor(request.args.get('before'))
+        messages = timelines.get_home_timeline(
+            g.user, limit=timelines.TIMELINE_LENGTH + 1, before=before)
+        page = make_page(messages, timelines.TIMELINE_LENGTH, message_key)
+
+        liked_ids = g.user.liked_ids_among([m.id for m in page.items])
 
         return render_template(
             'home.html',
-            messages=messages)
+            messages=page.items,
+            liked_ids=liked_ids,
+            next_cursor=page.next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
-@app.after_request
-def add_header(response):
-    """Add non-caching headers on every request."""
+##############################################################################
+# Commands
+
+
+@app.cli.command('reconcile-counts')
+def reconcile_counts():
+    """Repair drift in the denormalized user counters."""
+
+    repaired = User.reconcile_counts()
+    db.session.commit()
+
+    print(f"Reconciled counters for {repaired} user(s).")
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every user's home timeline from follows and messages."""
+
+    timelines.rebuild_timelines(report=print)
+
+
+@app.cli.command('load-data')
+@click.argument('data_dir', default='generator')
+@click.option('--chunk-size', default=bulk_load.DEFAULT_CHUNK_SIZE,
+              help="Rows per COPY and commit.")
+@click.option('--resume', is_flag=True,
+              help="Continue an interrupted load instead of starting over.")
+def load_data(data_dir, chunk_size, resume):
+    """Bulk-load users/messages/follows/likes CSVs from DATA_DIR.
+
+    Tables should be empty (see `flask db upgrade`) unless resuming.
+    Counters and timelines are rebuilt once the load finishes.
+    """
+
+    stats = bulk_load.load_csvs(data_dir, chunk_size, resume)
+
+    User.reconcile_counts()
+    db.session.commit()
+    timelines.rebuild_timelines(report=print)
+
+    rows = sum(loaded for loaded, seconds in stats.values())
+    seconds = sum(seconds for loaded, seconds in stats.values())
+    print(f"Loaded {rows} rows in {seconds:.1f}s "
+          f"({rows / seconds if seconds else 0:,.0f} rows/s).")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static/ into static/dist/."""
+
+    manifest = static_assets.build(
+        app.static_folder, static_assets.dist_dir(app))
+
+    print(f"Built {len(manifest)} asset(s) into "
+          f"{static_assets.dist_dir(app)}.")
+
+
+@app.cli.command('worker')
+@click.option('--batch-size', default=jobs.DEFAULT_BATCH_SIZE,
+              help="Jobs claimed and committed together.")
+@click.option('--once', is_flag=True,
+              help="Run every job that's due, then exit.")
+def worker(batch_size, once):
+    """Run background jobs as they're queued."""
 
-    # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
-    return response
+    jobs.work(batch_size, once)
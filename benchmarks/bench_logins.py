@@ -0,0 +1,95 @@
+"""Benchmark password checks per second at different hashing pool sizes.
+
+Simulates a login burst: many request threads all verifying passwords at
+once through the same `Hasher` the app uses. Pool size 0 is the old
+behavior of hashing on the request thread.
+
+run like:
+
+    python benchmarks/bench_logins.py --pool-sizes 0,1,2,4 --threads 16
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from hashing import Hasher, HashingBusy, DEFAULT_ROUNDS  # noqa: E402
+
+
+def run(pool_size, threads, logins, rounds, queue_size):
+    """Check `logins` passwords across `threads` threads; return stats."""
+
+    hasher = Hasher(rounds=rounds, pool_size=pool_size,
+                    queue_size=queue_size, queue_timeout=30)
+    pw_hash = hasher.hash_password('password')
+
+    # Warm up the pool so process start-up isn't measured.
+    for _ in range(max(pool_size, 1)):
+        hasher.check_password(pw_hash, 'password')
+
+    rejected = 0
+
+    def login(_):
+        nonlocal rejected
+        try:
+            hasher.check_password(pw_hash, 'password')
+        except HashingBusy:
+            rejected += 1
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(login, range(logins)))
+    elapsed = perf_counter() - start
+
+    hasher.shutdown()
+
+    return {
+        'pool_size': pool_size,
+        'threads': threads,
+        'rounds': rounds,
+        'logins': logins,
+        'rejected': rejected,
+        'seconds': round(elapsed, 3),
+        'logins_per_second': round((logins - rejected) / elapsed, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--pool-sizes', default='0,1,2,4',
+                        help="comma-separated pool sizes to try")
+    parser.add_argument('--threads', type=int, default=16,
+                        help="concurrent request threads")
+    parser.add_argument('--logins', type=int, default=200,
+                        help="password checks per run")
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS,
+                        help="bcrypt work factor")
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help="hashing queue size")
+    parser.add_argument('--json', action='store_true',
+                        help="print results as JSON")
+    args = parser.parse_args()
+
+    results = [
+        run(int(size), args.threads, args.logins, args.rounds,
+            args.queue_size)
+        for size in args.pool_sizes.split(',')
+    ]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'pool':>5} {'logins/s':>10} {'seconds':>9} {'rejected':>9}")
+    for result in results:
+        print(f"{result['pool_size']:>5} {result['logins_per_second']:>10} "
+              f"{result['seconds']:>9} {result['rejected']:>9}")
+
+
+if __name__ == '__main__':
+    main()
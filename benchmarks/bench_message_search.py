@@ -0,0 +1,153 @@
+"""Benchmark full-text message search on a scaled-up copy of the seed data.
+
+Loads generator/messages.csv repeated `--scale` times (1000x is about a
+million messages) into a scratch Postgres database, then times message
+searches for words taken from the data.
+
+THIS DROPS AND RECREATES ALL TABLES in the target database.
+
+run like:
+
+    python benchmarks/bench_message_search.py \\
+        --database-url postgresql:///warbler_bench --scale 1000
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import re
+import sys
+from statistics import quantiles
+from time import perf_counter
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+
+def load(db, scale):
+    """Create tables and COPY users and `scale` copies of the messages."""
+
+    from models import User
+
+    db.drop_all()
+    db.create_all()
+
+    with open(os.path.join(ROOT, 'generator/users.csv')) as users:
+        db.session.bulk_insert_mappings(User, csv.DictReader(users))
+    db.session.commit()
+
+    with open(os.path.join(ROOT, 'generator/messages.csv')) as messages:
+        rows = list(csv.DictReader(messages))
+
+    connection = db.engine.raw_connection()
+    start = perf_counter()
+
+    try:
+        cursor = connection.cursor()
+
+        for _ in range(scale):
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in rows:
+                writer.writerow([row['text'], row['timestamp'],
+                                 row['user_id']])
+            buffer.seek(0)
+
+            cursor.copy_expert(
+                "COPY messages (text, timestamp, user_id) "
+                "FROM STDIN WITH (FORMAT csv)",
+                buffer)
+
+        cursor.execute("ANALYZE messages")
+        connection.commit()
+    finally:
+        connection.close()
+
+    return len(rows) * scale, perf_counter() - start
+
+
+def sample_terms(count, seed):
+    """Pick search terms from words that appear in the seed messages."""
+
+    with open(os.path.join(ROOT, 'generator/messages.csv')) as messages:
+        words = sorted({
+            word.lower()
+            for row in csv.DictReader(messages)
+            for word in re.findall(r'[A-Za-z]{4,}', row['text'])
+        })
+
+    rng = random.Random(seed)
+    terms = [rng.choice(words) for _ in range(count // 2)]
+    terms += [f"{rng.choice(words)} {rng.choice(words)}"
+              for _ in range(count - len(terms))]
+
+    return terms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True,
+                        help="scratch Postgres database to load into")
+    parser.add_argument('--scale', type=int, default=1000,
+                        help="how many copies of messages.csv to load")
+    parser.add_argument('--queries', type=int, default=200,
+                        help="number of searches to time")
+    parser.add_argument('--pages', type=int, default=3,
+                        help="result pages to fetch per search")
+    parser.add_argument('--skip-load', action='store_true',
+                        help="reuse data from a previous run")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from app import app, MESSAGES_PER_PAGE
+    from models import db
+    from pagination import decode_rank_cursor
+    import search
+
+    result = {'scale': args.scale}
+
+    if not args.skip_load:
+        rows, seconds = load(db, args.scale)
+        result['messages_loaded'] = rows
+        result['load_rows_per_second'] = round(rows / seconds)
+
+    timings = []
+    matched = 0
+
+    with app.test_request_context():
+        for term in sample_terms(args.queries, args.seed):
+            before = None
+
+            for _ in range(args.pages):
+                start = perf_counter()
+                page = search.search_messages(term, MESSAGES_PER_PAGE, before)
+                timings.append((perf_counter() - start) * 1000)
+
+                matched += len(page.items)
+                db.session.rollback()
+
+                if not page.next_cursor:
+                    break
+                before = decode_rank_cursor(page.next_cursor)
+
+    cuts = quantiles(timings, n=100)
+    result.update({
+        'searches': len(timings),
+        'results': matched,
+        'p50_ms': round(cuts[49], 2),
+        'p95_ms': round(cuts[94], 2),
+        'p99_ms': round(cuts[98], 2),
+        'max_ms': round(max(timings), 2),
+    })
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""Benchmark Warbler's main routes: latency percentiles and requests/second.
+
+Seeds a scratch database with generated data (see generator/create_csvs.py),
+then times each route with logged-in users, either in-process through the
+Flask test client or over HTTP against a local gunicorn. Results are JSON,
+tagged with the git commit, so runs can be saved and compared:
+
+    python benchmarks/bench_routes.py \\
+        --database-url postgresql:///warbler_bench --users 10000 \\
+        --output before.json
+
+    python benchmarks/bench_routes.py \\
+        --database-url postgresql:///warbler_bench --skip-load \\
+        --mode gunicorn --workers 4 --concurrency 16 \\
+        --output after.json --compare before.json
+
+THIS DROPS AND RECREATES ALL TABLES in the target database, unless
+--skip-load is given.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+from http.cookies import SimpleCookie
+from statistics import quantiles
+from time import perf_counter, sleep
+from urllib.parse import urlencode
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, ROOT)
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+# Route name -> (method, function of (rng, ids) returning the path).
+ROUTES = {
+    'homepage': ('GET', lambda rng, ids: "/"),
+    'show_user': ('GET', lambda rng, ids: f"/users/{rng.choice(ids.users)}"),
+    'list_users': ('GET', lambda rng, ids: "/users"),
+    'show_followers': (
+        'GET', lambda rng, ids: f"/users/{rng.choice(ids.users)}/followers"),
+    'like_unlike_message': (
+        'POST', lambda rng, ids: f"/messages/{rng.choice(ids.messages)}/like"),
+    'add_message': ('POST', lambda rng, ids: "/messages/new"),
+}
+
+
+class Ids:
+    """Ids of the users and messages in the benchmark database."""
+
+    def __init__(self, db):
+        from sqlalchemy import func, select
+
+        from models import Message, User
+
+        self.users = range(*db.session.execute(
+            select(func.min(User.id), func.max(User.id) + 1)).one())
+        self.messages = range(*db.session.execute(
+            select(func.min(Message.id), func.max(Message.id) + 1)).one())
+        db.session.rollback()
+
+
+def load(db, args):
+    """Generate CSVs and load them into freshly created tables."""
+
+    from bulk_load import load_csvs
+    from models import User
+    import timelines
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator/create_csvs.py'),
+             '--users', str(args.users),
+             '--messages-per-user', str(args.messages_per_user),
+             '--follows-per-user', str(args.follows_per_user),
+             '--likes-per-user', str(args.likes_per_user),
+             '--end-date', '2024-01-01',
+             '--seed', str(args.seed),
+             '--out-dir', out_dir],
+            check=True)
+
+        db.drop_all()
+        db.create_all()
+        load_csvs(out_dir, report=lambda line: None)
+
+    User.reconcile_counts()
+    db.session.commit()
+    timelines.rebuild_timelines()
+
+
+def session_cookie(app, user_id):
+    """A signed session cookie logging in `user_id`."""
+
+    from app import CURR_USER_KEY
+
+    return app.session_interface.get_signing_serializer(app).dumps(
+        {CURR_USER_KEY: user_id})
+
+
+class TestClient:
+    """Requests through the Flask test client, in this process."""
+
+    def __init__(self, app, cookie):
+        self.client = app.test_client()
+        self.client.set_cookie(app.config['SESSION_COOKIE_NAME'], cookie)
+
+    def request(self, method, path, data=None):
+        response = self.client.open(
+            path, method=method, data=data, headers={"Referer": "/"})
+        return response.status_code, response.get_data(as_text=True)
+
+
+class HTTPClient:
+    """Requests over a keep-alive HTTP connection, keeping cookies."""
+
+    def __init__(self, port, cookie_name, cookie):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port)
+        self.cookies = {cookie_name: cookie}
+
+    def request(self, method, path, data=None):
+        headers = {
+            "Referer": "/",
+            "Cookie": "; ".join(f"{k}={v}" for k, v in self.cookies.items()),
+        }
+        body = None
+
+        if data is not None:
+            body = urlencode(data)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        text = response.read().decode('utf-8')
+
+        for header in response.headers.get_all('Set-Cookie') or []:
+            for name, morsel in SimpleCookie(header).items():
+                self.cookies[name] = morsel.value
+
+        return response.status, text
+
+
+def start_gunicorn(workers, port):
+    """Start gunicorn serving the app; return the process once it's up."""
+
+    process = subprocess.Popen(
+        ['gunicorn', '--workers', str(workers),
+         '--bind', f"127.0.0.1:{port}", 'app:app'],
+        cwd=ROOT)
+
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            if process.poll() is not None:
+                raise SystemExit("gunicorn failed to start")
+            sleep(0.1)
+
+    process.terminate()
+    raise SystemExit("gunicorn didn't start listening")
+
+
+def run_route(name, clients, ids, requests, warmup, seed):
+    """Time `requests` requests to route `name`, spread over `clients`
+    running concurrently."""
+
+    method, make_path = ROUTES[name]
+    timings = []
+    errors = 0
+    lock = threading.Lock()
+
+    def worker(index, client, count):
+        nonlocal errors
+        rng = random.Random(f"{seed}:{name}:{index}")
+        local = []
+        failed = 0
+
+        for i in range(warmup + count):
+            data = None
+            if method == 'POST':
+                data = {'csrf_token': client.csrf_token}
+                if name == 'add_message':
+                    data['text'] = f"Benchmark message {index}-{i}"
+
+            start = perf_counter()
+            status, _ = client.request(method, make_path(rng, ids), data)
+            elapsed = (perf_counter() - start) * 1000
+
+            if i >= warmup:
+                local.append(elapsed)
+                failed += status >= 400
+
+        with lock:
+            timings.extend(local)
+            errors += failed
+
+    shares = [requests // len(clients)
+              + (i < requests % len(clients)) for i in range(len(clients))]
+    threads = [threading.Thread(target=worker, args=(i, client, share))
+               for i, (client, share) in enumerate(zip(clients, shares))]
+
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    cuts = quantiles(timings, n=100)
+
+    return {
+        'requests': len(timings),
+        'errors': errors,
+        'p50_ms': round(cuts[49], 2),
+        'p95_ms': round(cuts[94], 2),
+        'p99_ms': round(cuts[98], 2),
+        'max_ms': round(max(timings), 2),
+        'requests_per_second': round(len(timings) / elapsed, 1),
+    }
+
+
+def git_commit():
+    """The checked-out commit, or None outside a git checkout."""
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, baseline_path):
+    """Print each route's change from a saved result, to stderr."""
+
+    with open(baseline_path) as file:
+        baseline = json.load(file)
+
+    print(f"Compared with {baseline.get('commit')}:", file=sys.stderr)
+
+    for name, now in result['routes'].items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            continue
+
+        changes = ", ".join(
+            f"{key} {before[key]} -> {now[key]} "
+            f"({(now[key] - before[key]) / before[key]:+.0%})"
+            for key in ('p50_ms', 'p95_ms', 'p99_ms', 'requests_per_second')
+            if before[key])
+        print(f"  {name}: {changes}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', required=True,
+                        help="scratch database to load into")
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages-per-user', type=float, default=20)
+    parser.add_argument('--follows-per-user', type=float, default=20)
+    parser.add_argument('--likes-per-user', type=float, default=20)
+    parser.add_argument('--skip-load', action='store_true',
+                        help="reuse data from a previous run")
+    parser.add_argument('--mode', choices=['client', 'gunicorn'],
+                        default='client',
+                        help="Flask test client, or HTTP to a local gunicorn")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="gunicorn worker processes")
+    parser.add_argument('--port', type=int, default=5099)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="simultaneous clients, each a different user")
+    parser.add_argument('--requests', type=int, default=500,
+                        help="timed requests per route")
+    parser.add_argument('--warmup', type=int, default=10,
+                        help="untimed requests per client before timing")
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help="comma-separated routes to time")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results to this file")
+    parser.add_argument('--compare',
+                        help="results file from an earlier run to compare")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    os.environ.setdefault('SECRET_KEY', 'bench')
+
+    from app import app
+    from models import db
+
+    if not args.skip_load:
+        load(db, args)
+
+    ids = Ids(db)
+    rng = random.Random(args.seed)
+    viewers = [rng.choice(ids.users) for _ in range(args.concurrency)]
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+
+    server = None
+    if args.mode == 'gunicorn':
+        server = start_gunicorn(args.workers, args.port)
+
+    try:
+        clients = []
+        for user_id in viewers:
+            cookie = session_cookie(app, user_id)
+            client = (TestClient(app, cookie) if args.mode == 'client'
+                      else HTTPClient(args.port, cookie_name, cookie))
+
+            # Any logged-in page has a CSRF token for the session
+            _, html = client.request('GET', "/users/profile")
+            client.csrf_token = CSRF_TOKEN.search(html)[1]
+            clients.append(client)
+
+        routes = {
+            name: run_route(name, clients, ids, args.requests, args.warmup,
+                            args.seed)
+            for name in args.routes.split(',')
+        }
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    result = {
+        'commit': git_commit(),
+        'mode': args.mode,
+        'workers': args.workers if args.mode == 'gunicorn' else None,
+        'concurrency': args.concurrency,
+        'dataset': {
+            'users': len(ids.users),
+            'messages': len(ids.messages),
+            'seed': args.seed,
+        },
+        'routes': routes,
+    }
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        compare(result, args.compare)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Bulk-load Warbler data from CSV files.
+
+Used by seed.py and `flask load-data` to load fixture data far faster than
+going through the ORM:
+
+- On Postgres, rows are streamed to `COPY ... FROM STDIN` in chunks of
+  `chunk_size`, each committed as it's loaded.
+- Secondary indexes on the tables being loaded are dropped first and
+  rebuilt once all the data is in, which is much cheaper than updating
+  them row by row.
+- Tables whose CSV has no `id` column get ids numbered from the row
+  number, so messages.csv can refer to users by their position in
+  users.csv. Sequences are moved past the loaded ids afterwards.
+- Progress is recorded in the `bulk_load_progress` table in the same
+  transaction as each chunk. After an interruption, loading again with
+  `resume=True` skips the rows that were already committed, and restores
+  any indexes that were dropped.
+
+Other databases (SQLite test runs) insert each chunk with executemany and
+don't defer indexes.
+"""
+
+import csv
+import io
+import os
+from itertools import islice
+from time import perf_counter
+
+from models import db
+
+# Load order, parents before children. Files that don't exist are skipped.
+TABLES = ('users', 'messages', 'follows', 'likes')
+
+DEFAULT_CHUNK_SIZE = 50000
+
+
+def load_csvs(data_dir, chunk_size=DEFAULT_CHUNK_SIZE, resume=False,
+              report=print):
+    """Load `<table>.csv` from `data_dir` into each table in TABLES.
+
+    Tables should be empty unless resuming. Returns a dict of
+    {table: (rows loaded, seconds)}. Progress lines are passed to `report`.
+    """
+
+    tables = [table for table in TABLES
+              if os.path.exists(os.path.join(data_dir, f'{table}.csv'))]
+
+    connection = db.engine.raw_connection()
+    is_postgres = db.engine.dialect.name == 'postgresql'
+    stats = {}
+
+    try:
+        _create_bookkeeping(connection)
+
+        if not resume:
+            _reset_progress(connection)
+
+        if is_postgres:
+            _drop_indexes(connection, tables)
+
+        for table in tables:
+            path = os.path.join(data_dir, f'{table}.csv')
+            stats[table] = _load_table(
+                connection, table, path, chunk_size, is_postgres, report)
+
+        if is_postgres:
+            report("Rebuilding indexes...")
+            _restore_indexes(connection)
+            _reset_sequences(connection, tables)
+
+            cursor = connection.cursor()
+            for table in tables:
+                cursor.execute(f"ANALYZE {table}")
+            connection.commit()
+    finally:
+        connection.close()
+
+    return stats
+
+
+def _load_table(connection, table, path, chunk_size, is_postgres, report):
+    """Load one CSV file into `table`, chunk by chunk."""
+
+    cursor = connection.cursor()
+    done = _rows_done(connection, table)
+    loaded = 0
+    start = perf_counter()
+
+    with open(path, newline='') as csv_file:
+        reader = csv.reader(csv_file)
+        columns = next(reader)
+
+        # Number rows ourselves so ids match row positions even if an
+        # interrupted load used up some sequence values.
+        numbered = 'id' in db.metadata.tables[table].c and 'id' not in columns
+        if numbered:
+            columns = ['id'] + columns
+
+        rows = islice(reader, done, None)
+        row_number = done
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            if numbered:
+                chunk = [[row_number + i + 1] + row
+                         for i, row in enumerate(chunk)]
+            row_number += len(chunk)
+
+            if is_postgres:
+                _copy_chunk(cursor, table, columns, chunk)
+            else:
+                _insert_chunk(cursor, table, columns, chunk)
+
+            _save_progress(cursor, table, row_number)
+            connection.commit()
+
+            loaded += len(chunk)
+            elapsed = perf_counter() - start
+            report(f"{table}: {row_number} rows "
+                   f"({loaded / elapsed:,.0f} rows/s)")
+
+    seconds = perf_counter() - start
+
+    if done:
+        report(f"{table}: resumed after {done} rows")
+    report(f"{table}: loaded {loaded} rows in {seconds:.1f}s "
+           f"({loaded / seconds if seconds else 0:,.0f} rows/s)")
+
+    return loaded, seconds
+
+
+def _copy_chunk(cursor, table, columns, chunk):
+    """Stream `chunk` to the table with COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(chunk)
+    buffer.seek(0)
+
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def _insert_chunk(cursor, table, columns, chunk):
+    """Insert `chunk` with executemany, for databases without COPY."""
+
+    placeholders = ', '.join('?' for _ in columns)
+    cursor.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({placeholders})",
+        chunk)
+
+
+##############################################################################
+# Progress and deferred indexes
+
+
+def _create_bookkeeping(connection):
+    """Create the tables that make loads resumable, if they don't exist."""
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS bulk_load_progress ("
+        "table_name VARCHAR(64) PRIMARY KEY, rows_done BIGINT NOT NULL)")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS bulk_load_indexes ("
+        "index_name VARCHAR(64) PRIMARY KEY, definition TEXT NOT NULL)")
+    connection.commit()
+
+
+def _reset_progress(connection):
+    """Forget any previous load's progress."""
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM bulk_load_progress")
+    connection.commit()
+
+
+def _rows_done(connection, table):
+    """Rows of `table`'s CSV already loaded by an earlier run."""
+
+    cursor = connection.cursor()
+    cursor.execute(
+        _sql("SELECT rows_done FROM bulk_load_progress "
+             "WHERE table_name = %s"),
+        (table,))
+    row = cursor.fetchone()
+
+    return row[0] if row else 0
+
+
+def _save_progress(cursor, table, rows_done):
+    """Record progress; runs in the same transaction as the chunk."""
+
+    cursor.execute(
+        _sql("DELETE FROM bulk_load_progress WHERE table_name = %s"),
+        (table,))
+    cursor.execute(
+        _sql("INSERT INTO bulk_load_progress (table_name, rows_done) "
+             "VALUES (%s, %s)"),
+        (table, rows_done))
+
+
+def _sql(sql):
+    """Adapt %s placeholders for DB-API drivers that use ? instead."""
+
+    if db.engine.dialect.name == 'postgresql':
+        return sql
+    return sql.replace('%s', '?')
+
+
+def _drop_indexes(connection, tables):
+    """Drop secondary indexes on `tables`, saving how to rebuild them.
+
+    Indexes that back a constraint (primary keys, unique columns) are left
+    alone. Definitions are committed before dropping, so an interrupted
+    load can still rebuild them.
+    """
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT i.relname, pg_get_indexdef(i.oid) "
+        "FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "JOIN pg_class t ON t.oid = x.indrelid "
+        "WHERE t.relname = ANY(%s) "
+        "AND NOT EXISTS ("
+        "    SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)",
+        (list(tables),))
+    indexes = cursor.fetchall()
+
+    for name, definition in indexes:
+        cursor.execute(
+            "INSERT INTO bulk_load_indexes (index_name, definition) "
+            "VALUES (%s, %s) ON CONFLICT (index_name) DO NOTHING",
+            (name, definition))
+    connection.commit()
+
+    for name, definition in indexes:
+        cursor.execute(f'DROP INDEX IF EXISTS "{name}"')
+    connection.commit()
+
+
+def _restore_indexes(connection):
+    """Rebuild the indexes saved by `_drop_indexes`."""
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT index_name, definition FROM bulk_load_indexes")
+
+    for name, definition in cursor.fetchall():
+        cursor.execute(
+            definition.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1)
+            .replace('CREATE UNIQUE INDEX',
+                     'CREATE UNIQUE INDEX IF NOT EXISTS', 1))
+        cursor.execute(
+            "DELETE FROM bulk_load_indexes WHERE index_name = %s", (name,))
+        connection.commit()
+
+
+def _reset_sequences(connection, tables):
+    """Move id sequences past the highest loaded id."""
+
+    cursor = connection.cursor()
+
+    for table in tables:
+        if 'id' not in db.metadata.tables[table].c:
+            continue
+
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), "
+            f"COALESCE((SELECT MAX(id) FROM {table}), 0) + 1, false)",
+            (table,))
+
+    connection.commit()
@@ -0,0 +1,217 @@
+"""Fragment cache for rendered message cards.
+
+Message lists (home timeline, profile pages, search) render the same card
+for a message no matter who is looking, apart from the like button. We
+cache each card's HTML, keyed by the message id and its author's
+`profile_version`, and templates stitch the per-viewer like form in
+between the cached head and tail. The `message_list` macro in
+templates/messages/_list.html does this for every message list:
+
+    {% set cards = message_cards(messages) %}
+    {% for msg in messages %}
+      {{ cards[msg.id].head }}
+      ... like form ...
+      {{ cards[msg.id].tail }}
+    {% endfor %}
+
+Messages can't be edited, so a card only goes stale when its author
+changes their username or picture, which bumps `profile_version`. Keys
+also include a hash of the card template, so a deploy that changes the
+template doesn't serve old markup.
+
+Config:
+
+- FRAGMENT_CACHE_SIZE: cards kept in each process's LRU cache (default
+  10000).
+- FRAGMENT_CACHE_URL: optional redis:// URL of a cache shared by all
+  workers, used instead of the per-process one. Needs the `redis`
+  package.
+- FRAGMENT_CACHE_TTL: seconds cards are kept in the shared cache
+  (default one day).
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+from markupsafe import Markup
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 10000
+DEFAULT_TTL = 24 * 60 * 60
+
+CARD_TEMPLATE = 'messages/_card.html'
+
+# Where the per-viewer part of a card goes.
+VIEWER_SLOT = '<!-- viewer -->'
+
+Card = namedtuple('Card', ['head', 'tail'])
+
+
+class LocalBackend:
+    """Thread-safe in-process LRU cache of rendered fragments."""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.fragments = OrderedDict()
+
+    def get_many(self, keys):
+        """Return {key: html} for the keys that are cached."""
+
+        found = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.fragments:
+                    self.fragments.move_to_end(key)
+                    found[key] = self.fragments[key]
+
+        return found
+
+    def set_many(self, fragments):
+        """Cache {key: html}, evicting the least recently used if full."""
+
+        with self.lock:
+            self.fragments.update(fragments)
+
+            for key in fragments:
+                self.fragments.move_to_end(key)
+
+            while len(self.fragments) > self.size:
+                self.fragments.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached fragment."""
+
+        with self.lock:
+            self.fragments.clear()
+
+
+class RedisBackend:
+    """Fragments shared by every worker, kept in Redis.
+
+    If Redis is unreachable, lookups miss and cards are rendered as if
+    there were no cache.
+    """
+
+    def __init__(self, url, ttl=DEFAULT_TTL):
+        if redis is None:
+            raise RuntimeError("FRAGMENT_CACHE_URL needs the redis package")
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get_many(self, keys):
+        """Return {key: html} for the keys that are cached."""
+
+        if not keys:
+            return {}
+
+        try:
+            values = self.client.mget(keys)
+        except redis.RedisError:
+            logger.warning("Fragment cache unavailable", exc_info=True)
+            return {}
+
+        return {key: value.decode('utf-8')
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, fragments):
+        """Cache {key: html} for `ttl` seconds."""
+
+        pipeline = self.client.pipeline(transaction=False)
+        for key, html in fragments.items():
+            pipeline.set(key, html, ex=self.ttl)
+
+        try:
+            pipeline.execute()
+        except redis.RedisError:
+            logger.warning("Fragment cache unavailable", exc_info=True)
+
+    def clear(self):
+        """Shared fragments expire on their own; nothing to do."""
+
+
+class FragmentCache:
+    """Renders message cards, reusing cached HTML where possible."""
+
+    def __init__(self):
+        self.backend = LocalBackend()
+        self.template_hash = None
+
+    def configure(self, app):
+        """Pick the backend from app config."""
+
+        url = app.config.get('FRAGMENT_CACHE_URL')
+
+        if url:
+            self.backend = RedisBackend(
+                url, app.config.get('FRAGMENT_CACHE_TTL', DEFAULT_TTL))
+        else:
+            self.backend = LocalBackend(
+                app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_SIZE))
+
+    def _template_hash(self):
+        """Short hash of the card template's source."""
+
+        if self.template_hash is None:
+            env = current_app.jinja_env
+            source, _, _ = env.loader.get_source(env, CARD_TEMPLATE)
+            self.template_hash = hashlib.sha1(
+                source.encode('utf-8')).hexdigest()[:8]
+
+        return self.template_hash
+
+    def message_cards(self, messages):
+        """Return {message id: Card} for `messages`.
+
+        Looks up every card in one batch, renders the misses and caches
+        them.
+        """
+
+        version = self._template_hash()
+        keys = {
+            msg.id: f"card:{version}:{msg.id}:{msg.user.profile_version}"
+            for msg in messages
+        }
+
+        cached = self.backend.get_many(list(keys.values()))
+        rendered = {}
+        cards = {}
+        template = None
+
+        for msg in messages:
+            key = keys[msg.id]
+            html = cached.get(key)
+
+            if html is None:
+                template = template or current_app.jinja_env.get_template(
+                    CARD_TEMPLATE)
+                html = rendered[key] = template.render(msg=msg)
+
+            head, tail = html.split(VIEWER_SLOT, 1)
+            cards[msg.id] = Card(Markup(head), Markup(tail))
+
+        if rendered:
+            self.backend.set_many(rendered)
+
+        return cards
+
+
+cache = FragmentCache()
+
+
+def init_app(app):
+    """Configure the cache and make `message_cards` available to templates."""
+
+    cache.configure(app)
+    app.jinja_env.globals['message_cards'] = cache.message_cards
@@ -2,88 +2,252 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, for example to build
+large fixtures for load testing:
+
+    python generator/create_csvs.py --users 1000000 --processes 8 \\
+        --out-dir /tmp/warbler-1m
+    flask load-data /tmp/warbler-1m
+
+Rows are written as they're generated, so memory use doesn't grow with
+the size of the data. Each user's rows come from a random generator seeded
+with `--seed` and the user's id, so the same arguments always produce the
+same files, however many processes are used. No network access is needed.
+
+Followed users and liked messages are picked from a power-law
+distribution (`--follow-alpha`, `--like-alpha`): a few users get most of
+the followers and a few messages get most of the likes, as on real sites.
+How many messages, follows and likes each user has is exponentially
+distributed around the given means.
+
+The CSVs have a header row and are ready for `COPY ... (FORMAT csv,
+HEADER)`; `flask load-data` loads them that way.
 """
 
+import argparse
+import csv
 import os
-from dotenv import load_dotenv
+import random
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
 from faker import Faker
-from helpers import get_random_datetime
 
-load_dotenv()
-
-UNSPLASH_CID = os.environ['UNSPLASH_CID']
+from helpers import (
+    HEADER_IMAGE_URLS, IMAGE_URLS, Shuffle, get_random_datetime,
+    power_law_rank)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['message_id', 'user_id']
+
+# Every user's password is "password".
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# Give up picking distinct follows/likes for a user after this many tries
+# per row wanted; matters only when a user wants nearly every row.
+MAX_TRIES_PER_PICK = 20
 
 fake = Faker()
 
-# Generate random profile image URLs to use for users
-
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
-
-# Generate random header image URLs to use for users
-# NOTE: You will need to create a dev account at unsplash.com, 
-# generate an access key and set that to an environment
-# variable to successfully ping the API. 
-
-header_image_urls = [
-    requests.get(
-        "https://api.unsplash.com/topics/wallpapers/photos" \
-        f"?per_page=30&orientation=landscape&client_id={UNSPLASH_CID}"
-    ).json()[i]['urls']['regular'] for i in range(0,29)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+
+def rng_for(args, kind, user_id):
+    """Random generator for one user's rows of one kind."""
+
+    return random.Random(f"{args.seed}:{kind}:{user_id}")
+
+
+def how_many(rng, mean, limit):
+    """Exponentially distributed count with the given mean, up to `limit`."""
+
+    if mean <= 0:
+        return 0
+
+    return min(limit, int(rng.expovariate(1 / mean) + 0.5))
+
+
+def pick_distinct(rng, count, pick, exclude=None):
+    """Return up to `count` distinct values from calling `pick(rng)`."""
+
+    picked = set()
+    tries = count * MAX_TRIES_PER_PICK
+
+    while len(picked) < count and tries:
+        value = pick(rng)
+        if value != exclude:
+            picked.add(value)
+        tries -= 1
+
+    return sorted(picked)
+
+
+def user_rows(args, first, last):
+    for user_id in range(first, last + 1):
+        rng = rng_for(args, 'user', user_id)
+        fake.seed_instance(rng.random())
+
+        username = f"{fake.user_name()[:20]}{user_id}"
+
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(IMAGE_URLS),
+            PASSWORD_HASH,
+            fake.sentence(),
+            rng.choice(HEADER_IMAGE_URLS),
+            fake.city()[:30],
+        ]
+
+
+def message_rows(args, first, last):
+    for user_id in range(first, last + 1):
+        rng = rng_for(args, 'messages', user_id)
+        fake.seed_instance(rng.random())
+
+        for _ in range(how_many(rng, args.messages_per_user, 10 ** 9)):
+            yield [
+                fake.paragraph()[:MAX_WARBLER_LENGTH],
+                get_random_datetime(now=args.end_date, rng=rng),
+                user_id,
+            ]
+
+
+def follow_rows(args, first, last):
+    shuffle = Shuffle(args.users, rng_for(args, 'shuffle', 0))
+
+    def pick(rng):
+        return shuffle(power_law_rank(rng, args.users, args.follow_alpha))
+
+    for user_id in range(first, last + 1):
+        rng = rng_for(args, 'follows', user_id)
+        count = how_many(rng, args.follows_per_user, args.users - 1)
+
+        for followed_id in pick_distinct(rng, count, pick, exclude=user_id):
+            yield [followed_id, user_id]
+
+
+def like_rows(args, first, last):
+    shuffle = Shuffle(args.total_messages,
+                      rng_for(args, 'shuffle', 0))
+
+    def pick(rng):
+        return shuffle(
+            power_law_rank(rng, args.total_messages, args.like_alpha))
+
+    for user_id in range(first, last + 1):
+        rng = rng_for(args, 'likes', user_id)
+        count = how_many(rng, args.likes_per_user, args.total_messages)
+
+        for message_id in pick_distinct(rng, count, pick):
+            yield [message_id, user_id]
+
+
+ROW_GENERATORS = {
+    'users': user_rows,
+    'messages': message_rows,
+    'follows': follow_rows,
+    'likes': like_rows,
+}
+
+
+def write_part(args, kind, path, first, last):
+    """Write `kind` rows for users `first` to `last` to `path`.
+
+    Returns the number of rows written.
+    """
+
+    count = 0
+
+    with open(path, 'w', newline='') as part:
+        writer = csv.writer(part)
+        for row in ROW_GENERATORS[kind](args, first, last):
+            writer.writerow(row)
+            count += 1
+
+    return count
+
+
+def write_csv(args, kind, headers, parts_dir):
+    """Generate `<kind>.csv` in the output directory; return its row count.
+
+    The users are split into ranges that are written to separate part
+    files (in parallel if `--processes` > 1), then joined in order.
+    """
+
+    step = max(1, -(-args.users // (args.processes * 4)))
+    ranges = [(first, min(args.users, first + step - 1))
+              for first in range(1, args.users + 1, step)]
+    paths = [os.path.join(parts_dir, f'{kind}.{i}.csv')
+             for i in range(len(ranges))]
+
+    jobs = [(args, kind, path, first, last)
+            for path, (first, last) in zip(paths, ranges)]
+
+    if args.processes > 1:
+        with ProcessPoolExecutor(args.processes) as pool:
+            counts = list(pool.map(write_part, *zip(*jobs)))
+    else:
+        counts = [write_part(*job) for job in jobs]
+
+    with open(os.path.join(args.out_dir, f'{kind}.csv'), 'w',
+              newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        for path in paths:
+            with open(path, newline='') as part:
+                shutil.copyfileobj(part, out)
+            os.remove(path)
+
+    print(f"{kind}.csv: {sum(counts)} rows")
+
+    return sum(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages-per-user', type=float, default=3.3,
+                        help="mean messages per user")
+    parser.add_argument('--follows-per-user', type=float, default=16.7,
+                        help="mean users followed per user")
+    parser.add_argument('--likes-per-user', type=float, default=0,
+                        help="mean messages liked per user")
+    parser.add_argument('--follow-alpha', type=float, default=1.0,
+                        help="power-law exponent for follower counts "
+                             "(0 is uniform)")
+    parser.add_argument('--like-alpha', type=float, default=1.0,
+                        help="power-law exponent for like counts "
+                             "(0 is uniform)")
+    parser.add_argument('--end-date', type=datetime.fromisoformat,
+                        default=datetime.combine(datetime.today(),
+                                                 datetime.min.time()),
+                        help="messages are dated in the two years before "
+                             "this (default: today)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--out-dir', default='generator')
+    args = parser.parse_args()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=args.out_dir) as parts_dir:
+        write_csv(args, 'users', USERS_CSV_HEADERS, parts_dir)
+        args.total_messages = write_csv(
+            args, 'messages', MESSAGES_CSV_HEADERS, parts_dir)
+        write_csv(args, 'follows', FOLLOWS_CSV_HEADERS, parts_dir)
+
+        likes_path = os.path.join(args.out_dir, 'likes.csv')
+        if args.likes_per_user and args.total_messages:
+            write_csv(args, 'likes', LIKES_CSV_HEADERS, parts_dir)
+        elif os.path.exists(likes_path):
+            # Don't leave likes from an earlier run pointing at new data.
+            os.remove(likes_path)
+
+
+if __name__ == '__main__':
+    main()
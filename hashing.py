@@ -0,0 +1,140 @@
+"""Password hashing for Warbler, off the request thread.
+
+bcrypt is deliberately slow, and it's CPU-bound: a burst of logins can
+keep every web worker busy hashing. Hashing runs in a small process pool
+instead, behind a bounded queue. When the queue is full, requests fail
+fast with 503 Service Unavailable instead of piling up.
+
+Config (read by `Hasher.init_app`):
+
+- BCRYPT_LOG_ROUNDS: bcrypt work factor for new hashes (default 12).
+  Existing hashes with a different cost are upgraded on the next login.
+- HASHING_POOL_SIZE: worker processes; 0 hashes inline (default 0 here;
+  app.py defaults it to 2).
+- HASHING_QUEUE_SIZE: jobs allowed to wait for a worker (default 16).
+- HASHING_QUEUE_TIMEOUT: seconds to wait for a queue slot (default 1).
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+DEFAULT_ROUNDS = 12
+DEFAULT_QUEUE_SIZE = 16
+DEFAULT_QUEUE_TIMEOUT = 1
+
+
+class HashingBusy(ServiceUnavailable):
+    """The hashing queue is full; the client should retry shortly."""
+
+    description = "The server is busy. Please try again in a moment."
+
+
+def _hash_password(password, rounds):
+    """bcrypt-hash `password` with the given work factor."""
+
+    salt = bcrypt.gensalt(rounds)
+    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+
+
+def _check_password(pw_hash, password):
+    """Does `password` match the bcrypt hash `pw_hash`?"""
+
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+def hash_cost(pw_hash):
+    """Return the work factor a bcrypt hash was made with."""
+
+    # Hashes look like $2b$12$<salt+hash>
+    return int(pw_hash.split('$')[2])
+
+
+class Hasher:
+    """Hashes and checks passwords in a bounded pool of processes."""
+
+    def __init__(self, rounds=DEFAULT_ROUNDS, pool_size=0,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.rounds = rounds
+        self.pool_size = pool_size
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.slots = threading.BoundedSemaphore(pool_size + queue_size)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+
+    def init_app(self, app):
+        """Configure from app config. Call before handling requests."""
+
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+        self.pool_size = app.config.get('HASHING_POOL_SIZE', 0)
+        self.queue_size = app.config.get(
+            'HASHING_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)
+        self.queue_timeout = app.config.get(
+            'HASHING_QUEUE_TIMEOUT', DEFAULT_QUEUE_TIMEOUT)
+        self.slots = threading.BoundedSemaphore(
+            self.pool_size + self.queue_size)
+
+    def _get_pool(self):
+        """Return this process's pool, starting it on first use.
+
+        Started lazily so that each forked web worker gets its own.
+        """
+
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    mp_context=multiprocessing.get_context('spawn'))
+                self.pool_pid = os.getpid()
+
+            return self.pool
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` in the pool and wait for the result.
+
+        Raises HashingBusy if no queue slot frees up in time.
+        """
+
+        if not self.pool_size:
+            return fn(*args)
+
+        if not self.slots.acquire(timeout=self.queue_timeout):
+            raise HashingBusy(retry_after=1)
+
+        try:
+            return self._get_pool().submit(fn, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash_password(self, password):
+        """Return a bcrypt hash of `password` at the configured cost."""
+
+        return self._run(_hash_password, password, self.rounds)
+
+    def check_password(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(_check_password, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than we now use?"""
+
+        return hash_cost(pw_hash) != self.rounds
+
+    def shutdown(self):
+        """Stop the worker processes, if any were started."""
+
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+hasher = Hasher()
@@ -0,0 +1,112 @@
+"""HTTP caching policies for Warbler pages.
+
+By default, responses are sent with `Cache-Control: no-store`, since
+nearly every page is rendered for the logged-in user. Pages that change
+rarely (message details, profiles) are instead revalidated: they are
+sent `private, no-cache` with a strong ETag built from the versions of
+the rows they show, and a client that sends a matching If-None-Match
+gets a `304 Not Modified` without the page being rendered:
+
+    tag = http_cache.etag(msg.id, msg.user.profile_version, ...)
+    return http_cache.conditional(
+        tag, lambda: render_template('messages/show.html', ...))
+
+The ETag must cover everything the page shows, including the viewer's
+own state (whether they like or follow what's shown). `etag` adds the
+viewer, their CSRF token state and the build (templates and static
+asset manifest) itself, so a deploy invalidates every cached page.
+"""
+
+import hashlib
+import os
+from time import time
+
+from flask import current_app, g, request, session
+
+import static_assets
+
+# Flask-WTF keeps the session's CSRF secret under this key.
+CSRF_SESSION_KEY = 'csrf_token'
+
+
+def _csrf_state():
+    """What the page's CSRF tokens depend on.
+
+    Signed tokens expire after WTF_CSRF_TIME_LIMIT seconds, so a cached
+    page may only be reused for half that; its forms then still have at
+    least half the limit left to be submitted.
+    """
+
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    window = int(time() // (limit / 2)) if limit else 0
+
+    return session.get(CSRF_SESSION_KEY), window
+
+
+def build_id():
+    """Hash of the app's templates and static asset manifest, computed
+    once per process.
+
+    Pages render differently after a deploy changes either, so their
+    ETags must change too.
+    """
+
+    app = current_app._get_current_object()
+
+    if 'http_cache.build_id' not in app.extensions:
+        digest = hashlib.sha1(
+            repr(sorted(static_assets.manifest().items())).encode('utf-8'))
+        template_dir = os.path.join(app.root_path, app.template_folder)
+
+        for directory, _, files in sorted(os.walk(template_dir)):
+            for name in sorted(files):
+                path = os.path.join(directory, name)
+                digest.update(os.path.relpath(path, template_dir)
+                              .encode('utf-8'))
+                with open(path, 'rb') as file:
+                    digest.update(file.read())
+
+        app.extensions['http_cache.build_id'] = digest.hexdigest()
+
+    return app.extensions['http_cache.build_id']
+
+
+def etag(*parts):
+    """Return a strong ETag for a page showing `parts` (ids and versions)
+    to the current user."""
+
+    viewer = (g.user.id, g.user.profile_version) if g.user else None
+    state = repr((parts, viewer, _csrf_state(), build_id()))
+
+    return hashlib.sha1(state.encode('utf-8')).hexdigest()
+
+
+def conditional(tag, render):
+    """Respond with `render()`, or 304 if the client has the page tagged
+    `tag`.
+
+    Pages with flashed messages waiting are always rendered, so the
+    messages get shown.
+    """
+
+    if request.if_none_match.contains(tag) and '_flashes' not in session:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.make_response(render())
+
+    response.set_etag(tag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+def init_app(app):
+    """Don't let clients store responses that didn't set a policy."""
+
+    @app.after_request
+    def default_to_no_store(response):
+        if not response.cache_control:
+            response.cache_control.no_store = True
+
+        return response
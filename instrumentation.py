@@ -0,0 +1,317 @@
+"""Request and SQL instrumentation for Warbler.
+
+Hooks into SQLAlchemy engine events and Flask request signals to record,
+for every request, how many SQL statements ran, how long they took, the
+slowest one, and how long template rendering took. Totals are kept per
+endpoint and served at /metrics in the Prometheus text format. Requests
+are recorded when they're torn down, so ones that raised are counted too.
+
+/metrics is only served to requests bearing METRICS_TOKEN
+("Authorization: Bearer <token>"), or, when no token is configured, to
+requests from this machine.
+
+Statements slower than SLOW_QUERY_THRESHOLD_MS are logged. When
+MAX_QUERIES_PER_REQUEST is set (the test suite sets it), any view that
+issues more statements than that fails loudly, so N+1 query regressions
+are caught by the tests instead of in production.
+
+Numbers are per process: with several gunicorn workers, each worker
+reports its own totals.
+"""
+
+import hmac
+import logging
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+from flask import (
+    Response, abort, before_render_template, current_app, g,
+    has_request_context, request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_QUERY_THRESHOLD_MS = 100
+LOCAL_ADDRESSES = {'127.0.0.1', '::1'}
+MAX_STATEMENT_LENGTH = 200
+
+
+class TooManyQueries(Exception):
+    """A view issued more SQL statements than MAX_QUERIES_PER_REQUEST."""
+
+
+class Metrics:
+    """Per-endpoint request totals, rendered in Prometheus text format.
+
+    Other modules can publish their own numbers by registering a collector
+    with `add_collector`. A collector is a function returning a list of
+    (name, type, help, samples) tuples, where samples is a list of
+    (labels dict, value) pairs.
+    """
+
+    COUNTERS = [
+        ('requests', 'warbler_requests_total',
+         "Requests handled."),
+        ('request_seconds', 'warbler_request_seconds_total',
+         "Time spent handling requests."),
+        ('errors', 'warbler_request_errors_total',
+         "Requests that raised an exception."),
+        ('queries', 'warbler_db_queries_total',
+         "SQL statements issued."),
+        ('db_seconds', 'warbler_db_seconds_total',
+         "Time spent in SQL statements."),
+        ('render_seconds', 'warbler_render_seconds_total',
+         "Time spent rendering templates."),
+        ('slow_queries', 'warbler_db_slow_queries_total',
+         "SQL statements slower than the slow query threshold."),
+    ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.collectors = []
+        self.reset()
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self.lock:
+            self.endpoints = defaultdict(lambda: defaultdict(float))
+            self.slowest = {}
+
+    def add_collector(self, collector):
+        """Register a function that reports extra metrics."""
+
+        self.collectors.append(collector)
+
+    def record(self, endpoint, stats):
+        """Add one request's numbers to the totals for `endpoint`."""
+
+        with self.lock:
+            totals = self.endpoints[endpoint]
+            totals['requests'] += 1
+
+            for key, _, _ in self.COUNTERS[1:]:
+                totals[key] += stats.get(key, 0)
+
+            slowest = stats.get('slowest')
+            if slowest and slowest[0] > self.slowest.get(endpoint, (0,))[0]:
+                self.slowest[endpoint] = slowest
+
+    def families(self):
+        """Return every metric as (name, type, help, samples) tuples."""
+
+        with self.lock:
+            families = [
+                (name, 'counter', help_text, [
+                    ({'endpoint': endpoint}, totals[key])
+                    for endpoint, totals in sorted(self.endpoints.items())
+                ])
+                for key, name, help_text in self.COUNTERS
+            ]
+
+            families.append((
+                'warbler_db_slowest_query_seconds', 'gauge',
+                "Slowest SQL statement seen, with its text.",
+                [({'endpoint': endpoint, 'statement': statement}, seconds)
+                 for endpoint, (seconds, statement)
+                 in sorted(self.slowest.items())],
+            ))
+
+        for collector in self.collectors:
+            families.extend(collector())
+
+        return families
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format."""
+
+        lines = []
+
+        for name, kind, help_text, samples in self.families():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    """Format a labels dict as {key="value",...}, escaping values."""
+
+    if not labels:
+        return ""
+
+    pairs = []
+    for key, value in labels.items():
+        value = (str(value)
+                 .replace('\\', '\\\\')
+                 .replace('"', '\\"')
+                 .replace('\n', '\\n'))
+        pairs.append(f'{key}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+def _shorten(statement):
+    """Collapse whitespace in a statement and cap its length."""
+
+    statement = " ".join(statement.split())
+
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        statement = statement[:MAX_STATEMENT_LENGTH - 3] + "..."
+
+    return statement
+
+
+metrics = Metrics()
+
+
+##############################################################################
+# SQLAlchemy engine events
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Note when a statement started."""
+
+    context._warbler_start = perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    """Charge a finished statement to the request; log it if it was slow."""
+
+    start = getattr(context, '_warbler_start', None)
+    if start is None:
+        return
+
+    elapsed = perf_counter() - start
+
+    threshold = DEFAULT_SLOW_QUERY_THRESHOLD_MS
+    if has_request_context():
+        threshold = current_app.config.get(
+            'SLOW_QUERY_THRESHOLD_MS', DEFAULT_SLOW_QUERY_THRESHOLD_MS)
+
+    is_slow = elapsed * 1000 >= threshold
+    if is_slow:
+        logger.warning(
+            "Slow query (%.1f ms)%s: %s",
+            elapsed * 1000,
+            f" in {request.endpoint}" if has_request_context() else "",
+            _shorten(statement))
+
+    if not has_request_context() or 'sql_stats' not in g:
+        return
+
+    stats = g.sql_stats
+    stats['queries'] += 1
+    stats['db_seconds'] += elapsed
+    stats['slow_queries'] += is_slow
+
+    if elapsed > stats['slowest'][0]:
+        stats['slowest'] = (elapsed, _shorten(statement))
+
+
+##############################################################################
+# Flask signals
+
+
+def _before_render(app, template, context, **extra):
+    """Note when a top-level template render started."""
+
+    if 'sql_stats' in g:
+        g.render_depth = g.get('render_depth', 0) + 1
+        if g.render_depth == 1:
+            g.render_start = perf_counter()
+
+
+def _after_render(app, template, context, **extra):
+    """Charge a finished top-level template render to the current request."""
+
+    if 'sql_stats' in g and g.get('render_depth'):
+        g.render_depth -= 1
+        if g.render_depth == 0:
+            g.sql_stats['render_seconds'] += perf_counter() - g.render_start
+
+
+def init_app(app):
+    """Start instrumenting every request to `app` and serve /metrics.
+
+    Call this before registering other before_request functions so that
+    statements they issue are counted too.
+    """
+
+    app.config.setdefault(
+        'SLOW_QUERY_THRESHOLD_MS', DEFAULT_SLOW_QUERY_THRESHOLD_MS)
+
+    for name, listener in [('before_cursor_execute', _before_execute),
+                           ('after_cursor_execute', _after_execute)]:
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_request_stats():
+        """Reset the per-request numbers."""
+
+        g.request_start = perf_counter()
+        g.render_depth = 0
+        g.sql_stats = {
+            'queries': 0,
+            'db_seconds': 0.0,
+            'render_seconds': 0.0,
+            'slow_queries': 0,
+            'slowest': (0.0, None),
+        }
+
+    @app.after_request
+    def check_query_limit(response):
+        """Fail the request if it issued too many SQL statements."""
+
+        stats = g.sql_stats
+        limit = app.config.get('MAX_QUERIES_PER_REQUEST')
+
+        if limit is not None and stats['queries'] > limit:
+            raise TooManyQueries(
+                f"{request.endpoint} issued {stats['queries']} SQL "
+                f"statements (limit {limit})")
+
+        return response
+
+    @app.teardown_request
+    def record_request_stats(exc):
+        """Add this request to the totals, whether or not it raised."""
+
+        # Only once per request, and not for contexts that never ran
+        # start_request_stats
+        stats = g.pop('sql_stats', None)
+        if stats is None:
+            return
+
+        stats['request_seconds'] = perf_counter() - g.request_start
+        stats['errors'] = exc is not None
+        metrics.record(request.endpoint or 'unknown', stats)
+
+    @app.get('/metrics')
+    def show_metrics():
+        """Serve instrumentation totals in Prometheus text format."""
+
+        token = app.config.get('METRICS_TOKEN')
+
+        if token:
+            given = request.headers.get('Authorization', '')
+            if not hmac.compare_digest(given.encode(),
+                                       f"Bearer {token}".encode()):
+                abort(401)
+        elif request.remote_addr not in LOCAL_ADDRESSES:
+            abort(403)
+
+        return Response(
+            metrics.render(),
+            mimetype='text/plain; version=0.0.4')
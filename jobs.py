@@ -0,0 +1,285 @@
+"""Background jobs for Warbler.
+
+Slow side effects of a request (like pushing a new message into every
+follower's timeline) are queued as jobs in the `jobs` table and run later
+by a worker process, so the request can return right away:
+
+    jobs.enqueue('timelines.fan_out', {'message_id': msg.id},
+                 key=f"timelines.fan_out:{msg.id}")
+    db.session.commit()
+
+A job is queued in the request's transaction, so it only exists if the
+request's changes are committed. Run workers with:
+
+    flask worker
+
+Work is registered with `@task`. Handlers run inside the worker's
+transaction and must not commit. A job that raises is retried with
+exponential backoff, up to JOB_MAX_ATTEMPTS times, and then marked
+'failed' for someone to look at.
+
+Workers claim due jobs in batches of up to --batch-size, each batch in
+one transaction (with SKIP LOCKED on Postgres, so several workers can run
+side by side). Each job runs in its own savepoint, so a failing job
+doesn't undo the rest of its batch. Tasks registered with `batch=True`
+get all of a batch's payloads in one call instead, and fall back to one
+at a time if that fails.
+
+Config:
+
+- JOB_MAX_ATTEMPTS: tries before a job is marked failed (default 5).
+- JOB_RETENTION_SECONDS: how long finished jobs (and so their idempotency
+  keys) are kept (default one day).
+
+Queue depth and lag, per kind of job, are served at /metrics.
+"""
+
+import logging
+import signal
+import traceback
+from datetime import datetime, timedelta
+from itertools import groupby
+from time import sleep
+
+from flask import current_app
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from instrumentation import metrics
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETENTION_SECONDS = 24 * 60 * 60
+DEFAULT_BATCH_SIZE = 100
+POLL_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60 * 60
+
+_tasks = {}
+
+
+def task(kind, batch=False):
+    """Register a function as the handler for jobs of `kind`.
+
+    The function is called with a job's payload, or with a list of
+    payloads if `batch` is true.
+    """
+
+    def register(handler):
+        _tasks[kind] = (handler, batch)
+        return handler
+
+    return register
+
+
+def enqueue(kind, payload, key=None, delay=0):
+    """Queue a job, to run `delay` seconds or more after it's committed.
+
+    If `key` is given and a job with that key is already queued (or ran
+    within JOB_RETENTION_SECONDS), nothing is queued.
+    """
+
+    values = dict(
+        kind=kind,
+        payload=payload,
+        idempotency_key=key,
+        status='queued',
+        attempts=0,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+        created_at=datetime.utcnow(),
+    )
+
+    dialect = db.engine.dialect.name
+
+    if key is not None and dialect in ('postgresql', 'sqlite'):
+        dialect_insert = (postgresql.insert if dialect == 'postgresql'
+                          else sqlite.insert)
+        statement = (dialect_insert(Job).values(**values)
+                     .on_conflict_do_nothing(
+                         index_elements=['idempotency_key']))
+    else:
+        statement = insert(Job).values(**values)
+
+    db.session.execute(statement)
+
+
+def _backoff(attempts):
+    """Seconds to wait before retrying a job that has failed `attempts`
+    times."""
+
+    return min(2 ** attempts, MAX_BACKOFF_SECONDS)
+
+
+def _failed(job, error):
+    """Record a failed attempt at `job`, and schedule a retry if it has
+    any left."""
+
+    now = datetime.utcnow()
+    max_attempts = current_app.config.get(
+        'JOB_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+
+    job.attempts += 1
+    job.last_error = ''.join(
+        traceback.format_exception_only(type(error), error)).strip()
+
+    if job.attempts >= max_attempts:
+        job.status = 'failed'
+        job.finished_at = now
+        logger.error("Job %s (%s) failed: %s",
+                     job.id, job.kind, job.last_error)
+    else:
+        job.run_at = now + timedelta(seconds=_backoff(job.attempts))
+        logger.warning("Job %s (%s) will be retried: %s",
+                       job.id, job.kind, job.last_error)
+
+
+def _done(jobs):
+    """Mark `jobs` as finished."""
+
+    now = datetime.utcnow()
+
+    for job in jobs:
+        job.status = 'done'
+        job.attempts += 1
+        job.finished_at = now
+
+
+def _run(kind, jobs):
+    """Run `jobs`, all of `kind`, each in a savepoint."""
+
+    if kind not in _tasks:
+        for job in jobs:
+            _failed(job, LookupError(f"No task registered for {kind!r}"))
+        return
+
+    handler, batch = _tasks[kind]
+
+    if batch and len(jobs) > 1:
+        try:
+            with db.session.begin_nested():
+                handler([job.payload for job in jobs])
+        except Exception:
+            logger.warning("Batch of %s %s jobs failed; running them one "
+                           "at a time", len(jobs), kind, exc_info=True)
+        else:
+            _done(jobs)
+            return
+
+    for job in jobs:
+        try:
+            with db.session.begin_nested():
+                handler([job.payload] if batch else job.payload)
+        except Exception as error:
+            _failed(job, error)
+        else:
+            _done([job])
+
+
+def run_batch(batch_size=DEFAULT_BATCH_SIZE):
+    """Claim up to `batch_size` due jobs, run them and commit.
+
+    Returns the number of jobs claimed.
+    """
+
+    jobs = db.session.scalars(
+        select(Job)
+        .where(Job.status == 'queued')
+        .where(Job.run_at <= datetime.utcnow())
+        .order_by(Job.run_at, Job.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    for kind, group in groupby(sorted(jobs, key=lambda job: job.kind),
+                               key=lambda job: job.kind):
+        _run(kind, list(group))
+
+    db.session.commit()
+
+    return len(jobs)
+
+
+def prune():
+    """Delete finished jobs older than JOB_RETENTION_SECONDS."""
+
+    retention = current_app.config.get(
+        'JOB_RETENTION_SECONDS', DEFAULT_RETENTION_SECONDS)
+
+    db.session.execute(
+        delete(Job)
+        .where(Job.status == 'done')
+        .where(Job.finished_at
+               < datetime.utcnow() - timedelta(seconds=retention))
+    )
+    db.session.commit()
+
+
+def work(batch_size=DEFAULT_BATCH_SIZE, once=False):
+    """Run jobs as they come due, until SIGTERM or Ctrl-C.
+
+    With `once`, run every job that's due and return.
+    """
+
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    previous = signal.signal(signal.SIGTERM, stop)
+
+    try:
+        while not stopping:
+            if run_batch(batch_size):
+                continue
+
+            if once:
+                break
+
+            prune()
+            sleep(POLL_SECONDS)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        db.session.rollback()
+        signal.signal(signal.SIGTERM, previous)
+
+
+def queue_metrics():
+    """Metrics collector reporting queue depth and lag by kind of job."""
+
+    now = datetime.utcnow()
+
+    queued = db.session.execute(
+        select(Job.kind, func.count(), func.min(Job.run_at))
+        .where(Job.status == 'queued')
+        .group_by(Job.kind)
+        .order_by(Job.kind)
+    ).all()
+
+    failed = db.session.execute(
+        select(Job.kind, func.count())
+        .where(Job.status == 'failed')
+        .group_by(Job.kind)
+        .order_by(Job.kind)
+    ).all()
+
+    return [
+        ('warbler_jobs_queued', 'gauge',
+         "Jobs waiting to run.",
+         [({'kind': kind}, count) for kind, count, _ in queued]),
+        ('warbler_jobs_lag_seconds', 'gauge',
+         "How long the oldest due job has been waiting.",
+         [({'kind': kind}, max(0.0, (now - oldest).total_seconds()))
+          for kind, _, oldest in queued]),
+        ('warbler_jobs_failed', 'gauge',
+         "Jobs that ran out of retries.",
+         [({'kind': kind}, count) for kind, count in failed]),
+    ]
+
+
+def init_app(app):
+    """Serve queue metrics for `app`."""
+
+    if queue_metrics not in metrics.collectors:
+        metrics.add_collector(queue_metrics)
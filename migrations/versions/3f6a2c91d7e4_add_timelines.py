@@ -0,0 +1,38 @@
+"""add timelines
+
+The precomputed home timelines (see timelines.py). The table starts out
+empty; fill it with `flask rebuild-timelines` once the code that writes to
+it is deployed, so that messages posted in between are included.
+
+Revision ID: 3f6a2c91d7e4
+Revises: 7e0998d20abb
+Create Date: 2026-10-18 20:33:02.417960
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f6a2c91d7e4'
+down_revision = '7e0998d20abb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timelines',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'message_id')
+    )
+    op.create_index('ix_timelines_user_id_timestamp', 'timelines',
+                    ['user_id', 'timestamp'])
+
+
+def downgrade():
+    op.drop_index('ix_timelines_user_id_timestamp', table_name='timelines')
+    op.drop_table('timelines')
@@ -0,0 +1,48 @@
+"""add likes.created_at
+
+When each like was made, so a user's likes page can list them most
+recently liked first. Likes made before this migration all get the time
+it ran, and fall back to message id order among themselves.
+
+The (user_id, created_at DESC, message_id DESC) index serves that page. On
+Postgres it's built CONCURRENTLY so that likes aren't blocked while it
+builds.
+
+Revision ID: 4c1f9e2b8a37
+Revises: 233ef76ac5aa
+Create Date: 2026-10-18 23:12:48.604317
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4c1f9e2b8a37'
+down_revision = '233ef76ac5aa'
+branch_labels = None
+depends_on = None
+
+INDEX_COLUMNS = [
+    'user_id', sa.text('created_at DESC'), sa.text('message_id DESC')]
+
+
+def upgrade():
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('created_at', sa.DateTime(), server_default=sa.func.now(), nullable=False))
+
+    if op.get_bind().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+        with op.get_context().autocommit_block():
+            op.create_index('ix_likes_user_id_created_at', 'likes',
+                            INDEX_COLUMNS, postgresql_concurrently=True)
+    else:
+        op.create_index('ix_likes_user_id_created_at', 'likes',
+                        INDEX_COLUMNS)
+
+
+def downgrade():
+    op.drop_index('ix_likes_user_id_created_at', table_name='likes')
+
+    with op.batch_alter_table('likes', schema=None) as batch_op:
+        batch_op.drop_column('created_at')
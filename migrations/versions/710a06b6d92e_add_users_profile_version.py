@@ -0,0 +1,29 @@
+"""add users.profile_version
+
+Version number for the parts of a user's profile shown on their message
+cards, used to key the message card fragment cache.
+
+Revision ID: 710a06b6d92e
+Revises: 758f34524f0b
+Create Date: 2026-10-18 22:04:37.520193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '710a06b6d92e'
+down_revision = '758f34524f0b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('profile_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('profile_version')
@@ -0,0 +1,52 @@
+"""add indexes for hot queries
+
+- messages (user_id, timestamp DESC, id DESC): a user's messages, newest
+  first, as profile pages and timeline backfill read them.
+- follows (user_following_id, user_being_followed_id): who a user follows.
+  The primary key leads with the followed user, so it can't serve this.
+- likes (user_id, message_id): what a user has liked. The primary key
+  leads with the message.
+
+On Postgres the indexes are built CONCURRENTLY so that writes to these
+tables aren't blocked while they build.
+
+Revision ID: 758f34524f0b
+Revises: e14d7f3b9a60
+Create Date: 2026-10-18 20:41:12.118342
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '758f34524f0b'
+down_revision = 'e14d7f3b9a60'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_messages_user_id_timestamp', 'messages',
+     ['user_id', sa.text('timestamp DESC'), sa.text('id DESC')]),
+    ('ix_follows_user_following_id', 'follows',
+     ['user_following_id', 'user_being_followed_id']),
+    ('ix_likes_user_id_message_id', 'likes',
+     ['user_id', 'message_id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns,
+                                postgresql_concurrently=True)
+    else:
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for name, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
@@ -0,0 +1,69 @@
+"""initial schema
+
+The original users, messages, follows and likes tables, as `db.create_all()`
+built them before any of the later tables, columns and indexes. Existing
+databases with that schema should be marked as being at this revision with
+`flask db stamp 7e0998d20abb`, then upgraded.
+
+Revision ID: 7e0998d20abb
+Revises:
+Create Date: 2026-10-18 20:30:49.650822
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e0998d20abb'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('users',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('email', sa.String(length=50), nullable=False),
+    sa.Column('username', sa.String(length=30), nullable=False),
+    sa.Column('image_url', sa.String(length=255), nullable=False),
+    sa.Column('header_image_url', sa.String(length=255), nullable=False),
+    sa.Column('bio', sa.Text(), nullable=False),
+    sa.Column('location', sa.String(length=30), nullable=False),
+    sa.Column('password', sa.String(length=100), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('email'),
+    sa.UniqueConstraint('username')
+    )
+
+    op.create_table('follows',
+    sa.Column('user_being_followed_id', sa.Integer(), nullable=False),
+    sa.Column('user_following_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_being_followed_id'], ['users.id'], ondelete='cascade'),
+    sa.ForeignKeyConstraint(['user_following_id'], ['users.id'], ondelete='cascade'),
+    sa.PrimaryKeyConstraint('user_being_followed_id', 'user_following_id')
+    )
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('text', sa.String(length=140), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+    op.create_table('likes',
+    sa.Column('message_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['message_id'], ['messages.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('message_id', 'user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('likes')
+    op.drop_table('messages')
+    op.drop_table('follows')
+    op.drop_table('users')
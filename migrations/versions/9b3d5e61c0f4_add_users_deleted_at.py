@@ -0,0 +1,70 @@
+"""add users.deleted_at and cascade likes
+
+- users.deleted_at marks an account as deleted while background jobs
+  remove its data (see accounts.py), with a partial index for counting
+  the accounts still pending.
+- The likes foreign keys get ON DELETE CASCADE, so deleting a message or
+  user can't be blocked by a like made while it was being deleted.
+
+On Postgres the new foreign keys are added NOT VALID and validated
+afterwards, and the index is built CONCURRENTLY, so that neither table is
+locked against writes while every row is read.
+Other databases keep their existing foreign keys, which they can't alter
+in place; deletion jobs remove likes before messages and users anyway.
+
+Revision ID: 9b3d5e61c0f4
+Revises: 4c1f9e2b8a37
+Create Date: 2026-10-18 23:48:15.271906
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b3d5e61c0f4'
+down_revision = '4c1f9e2b8a37'
+branch_labels = None
+depends_on = None
+
+# (constraint, column, referenced table), named as Postgres named them.
+LIKES_FOREIGN_KEYS = [
+    ('likes_message_id_fkey', 'message_id', 'messages'),
+    ('likes_user_id_fkey', 'user_id', 'users'),
+]
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('deleted_at', sa.DateTime(), nullable=True))
+
+    if op.get_bind().dialect.name != 'postgresql':
+        op.create_index('ix_users_deleted_at', 'users', ['deleted_at'],
+                        sqlite_where=sa.text('deleted_at IS NOT NULL'))
+        return
+
+    for name, column, table in LIKES_FOREIGN_KEYS:
+        op.drop_constraint(name, 'likes', type_='foreignkey')
+        op.create_foreign_key(name, 'likes', table, [column], ['id'],
+                              ondelete='CASCADE', postgresql_not_valid=True)
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_deleted_at', 'users', ['deleted_at'],
+                        postgresql_where=sa.text('deleted_at IS NOT NULL'),
+                        postgresql_concurrently=True)
+
+        for name, column, table in LIKES_FOREIGN_KEYS:
+            op.execute(f"ALTER TABLE likes VALIDATE CONSTRAINT {name}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for name, column, table in LIKES_FOREIGN_KEYS:
+            op.drop_constraint(name, 'likes', type_='foreignkey')
+            op.create_foreign_key(name, 'likes', table, [column], ['id'])
+
+    op.drop_index('ix_users_deleted_at', table_name='users')
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_column('deleted_at')
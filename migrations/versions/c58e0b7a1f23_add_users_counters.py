@@ -0,0 +1,86 @@
+"""add user counters
+
+Denormalized messages, followers, following and likes counts on users,
+filled in from the existing rows. The backfill runs in batches of
+BATCH_SIZE users; on Postgres each batch is committed on its own, so a
+large users table isn't locked for the whole backfill.
+
+Counts change between the backfill and the deploy of the code that keeps
+them up to date; run `flask reconcile-counts` after that deploy.
+
+Revision ID: c58e0b7a1f23
+Revises: 3f6a2c91d7e4
+Create Date: 2026-10-18 20:35:27.803114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e0b7a1f23'
+down_revision = '3f6a2c91d7e4'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+COUNTERS = ['messages_count', 'followers_count', 'following_count',
+            'likes_count']
+
+users = sa.table('users', sa.column('id'),
+                 *[sa.column(name) for name in COUNTERS])
+messages = sa.table('messages', sa.column('id'), sa.column('user_id'))
+follows = sa.table('follows', sa.column('user_being_followed_id'),
+                   sa.column('user_following_id'))
+likes = sa.table('likes', sa.column('user_id'))
+
+
+def _backfill_batch(start):
+    """Count the rows of users with ids in [start, start + BATCH_SIZE)."""
+
+    op.execute(
+        users.update()
+        .where(users.c.id >= start, users.c.id < start + BATCH_SIZE)
+        .values(
+            messages_count=(
+                sa.select(sa.func.count(messages.c.id))
+                .where(messages.c.user_id == users.c.id)
+                .scalar_subquery()),
+            followers_count=(
+                sa.select(sa.func.count())
+                .where(follows.c.user_being_followed_id == users.c.id)
+                .scalar_subquery()),
+            following_count=(
+                sa.select(sa.func.count())
+                .where(follows.c.user_following_id == users.c.id)
+                .scalar_subquery()),
+            likes_count=(
+                sa.select(sa.func.count())
+                .where(likes.c.user_id == users.c.id)
+                .scalar_subquery()),
+        )
+    )
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        for name in COUNTERS:
+            batch_op.add_column(sa.Column(name, sa.Integer(), server_default='0', nullable=False))
+
+    last_id = op.get_bind().scalar(sa.select(sa.func.max(users.c.id))) or 0
+    starts = range(0, last_id + 1, BATCH_SIZE)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for start in starts:
+                _backfill_batch(start)
+    else:
+        for start in starts:
+            _backfill_batch(start)
+
+
+def downgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        for name in reversed(COUNTERS):
+            batch_op.drop_column(name)
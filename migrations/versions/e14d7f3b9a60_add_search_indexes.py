@@ -0,0 +1,61 @@
+"""add search indexes
+
+Postgres only; other databases search with the in-process fallbacks in
+search.py.
+
+- The pg_trgm extension, with trigram indexes on users.username, location
+  and bio for substring search, and an index on lower(username) for
+  prefix search.
+- messages.search_vector, a generated tsvector of the message text, with
+  a GIN index for full-text search.
+
+The indexes are built CONCURRENTLY so that writes aren't blocked while
+they build. Adding the generated column rewrites the messages table,
+which is locked while that runs.
+
+Revision ID: e14d7f3b9a60
+Revises: c58e0b7a1f23
+Create Date: 2026-10-18 20:38:51.264387
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e14d7f3b9a60'
+down_revision = 'c58e0b7a1f23'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ("ix_users_username_lower_prefix",
+     "users (lower(username) text_pattern_ops)"),
+    ("ix_users_username_trgm", "users USING gin (username gin_trgm_ops)"),
+    ("ix_users_location_trgm", "users USING gin (location gin_trgm_ops)"),
+    ("ix_users_bio_trgm", "users USING gin (bio gin_trgm_ops)"),
+    ("ix_messages_search_vector", "messages USING gin (search_vector)"),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute("ALTER TABLE messages ADD COLUMN search_vector tsvector "
+               "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED")
+
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction.
+    with op.get_context().autocommit_block():
+        for name, definition in INDEXES:
+            op.execute(f"CREATE INDEX CONCURRENTLY {name} ON {definition}")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    for name, definition in reversed(INDEXES):
+        op.execute(f"DROP INDEX {name}")
+
+    op.execute("ALTER TABLE messages DROP COLUMN search_vector")
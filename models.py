@@ -2,11 +2,15 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import (
+    DDL, delete, event, func, or_, select, tuple_, update)
+from sqlalchemy.orm import contains_eager
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import hasher
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 DEFAULT_IMAGE_URL = (
     "https://icon-library.com/images/default-user-icon/" +
@@ -35,6 +39,16 @@ class Follow(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user, so "who does X follow"
+    # needs its own index.
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id',
+            'user_being_followed_id',
+        ),
+    )
+
 class Like(db.Model):
     """ Connection of liked messages <-> User  """
     __tablename__ = 'likes'
@@ -45,15 +59,34 @@ class Like(db.Model):
     # )
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id'),
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
         primary_key=True,
     )
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id'),
+        db.ForeignKey('users.id', ondelete='CASCADE'),
         primary_key=True,
     )
 
+    # Set by the database, so bulk loads without the column get it too.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=func.now(),
+    )
+
+    # The primary key leads with the message, so "what has X liked" needs
+    # its own indexes: one to look up likes, one to list them newest first.
+    __table_args__ = (
+        db.Index('ix_likes_user_id_message_id', 'user_id', 'message_id'),
+        db.Index(
+            'ix_likes_user_id_created_at',
+            'user_id',
+            created_at.desc(),
+            message_id.desc(),
+        ),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -107,6 +140,54 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, maintained alongside the rows they count so that
+    # profile pages don't have to load whole relationships to show them.
+    # `flask reconcile-counts` repairs any drift.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Bumped whenever something shown alongside the user's messages (their
+    # username or picture) changes, so cached renderings can be keyed by it.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default="0",
+    )
+
+    # Set when the user deletes their account. Their data is then removed
+    # in the background (see accounts.py), and the row last of all.
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
     messages = db.relationship('Message', backref="user")
 
     like_messages = db.relationship('Message', secondary = "likes")
@@ -122,6 +203,11 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def bump_profile_version(self):
+        """Mark cached renderings of this user's profile as stale."""
+
+        self.profile_version = User.profile_version + 1
+
     @classmethod
     def signup(cls, username, email, password, image_url=DEFAULT_IMAGE_URL):
         """Sign up user.
@@ -129,7 +215,7 @@ class User(db.Model):
         Hashes password and adds user to session.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash_password(password)
 
         user = User(
             username=username,
@@ -151,31 +237,285 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        If the user's hash was made with a different bcrypt cost than we
+        now use, it is replaced with a fresh one; the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).one_or_none()
+        user = cls.query.filter_by(
+            username=username, deleted_at=None).one_or_none()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check_password(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash_password(password)
                 return user
 
         return False
 
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """Return user `user_id`, or raise 404 if there's no such user or
+        their account is being deleted."""
+
+        return cls.query.filter_by(id=user_id, deleted_at=None).first_or_404()
+
+    @classmethod
+    def adjust_counts(cls, user_ids, **deltas):
+        """Add `deltas` to counter columns for one or more users.
+
+        `user_ids` is a user id, a list of ids, or a select of ids. The
+        update runs in the database so concurrent requests don't lose counts.
+
+            User.adjust_counts(user.id, messages_count=1)
+        """
+
+        if isinstance(user_ids, int):
+            user_ids = [user_ids]
+
+        values = {
+            name: getattr(cls, name) + delta
+            for name, delta in deltas.items()
+        }
+
+        db.session.execute(
+            update(cls)
+            .where(cls.id.in_(user_ids))
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
+        # Loaded users pick up the new values the next time they're read.
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, cls):
+                db.session.expire(obj, list(deltas))
+
+    @classmethod
+    def reconcile_counts(cls):
+        """Recompute every counter from the underlying tables.
+
+        Returns the number of users whose counters had drifted.
+        """
+
+        actual = {
+            'messages_count': (select(func.count(Message.id))
+                               .where(Message.user_id == cls.id)
+                               .scalar_subquery()),
+            'followers_count': (select(func.count())
+                                .where(Follow.user_being_followed_id == cls.id)
+                                .scalar_subquery()),
+            'following_count': (select(func.count())
+                                .where(Follow.user_following_id == cls.id)
+                                .scalar_subquery()),
+            'likes_count': (select(func.count())
+                            .where(Like.user_id == cls.id)
+                            .scalar_subquery()),
+        }
+
+        result = db.session.execute(
+            update(cls)
+            .where(or_(*[getattr(cls, name) != count
+                         for name, count in actual.items()]))
+            .values(**actual)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.expire_all()
+
+        return result.rowcount
+
+    def liked_ids_among(self, message_ids):
+        """Return the set of `message_ids` that this user has liked.
+
+        Lets message lists resolve every like star with one query.
+        """
+
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(Like.message_id)
+            .where(Like.user_id == self.id)
+            .where(Like.message_id.in_(message_ids))
+        ))
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        # Selecting from the model keeps the query ORM-enabled, so
+        # pending follows are flushed first
+        return db.session.scalar(select(
+            select(Follow)
+            .where(Follow.user_being_followed_id == self.id)
+            .where(Follow.user_following_id == other_user.id)
+            .exists()
+        ))
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        return db.session.scalar(select(
+            select(Follow)
+            .where(Follow.user_being_followed_id == other_user.id)
+            .where(Follow.user_following_id == self.id)
+            .exists()
+        ))
+
+    def follow(self, other_user):
+        """Follow `other_user`, updating both users' counters.
+
+        Returns False if already following them.
+        """
+
+        if self.is_following(other_user):
+            return False
+
+        db.session.add(Follow(user_following_id=self.id,
+                              user_being_followed_id=other_user.id))
+        User.adjust_counts(self.id, following_count=1)
+        User.adjust_counts(other_user.id, followers_count=1)
+
+        return True
+
+    def unfollow(self, other_user):
+        """Stop following `other_user`, updating both users' counters.
+
+        Returns False if not following them.
+        """
+
+        deleted = db.session.execute(
+            delete(Follow)
+            .where(Follow.user_following_id == self.id)
+            .where(Follow.user_being_followed_id == other_user.id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        if not deleted:
+            return False
+
+        User.adjust_counts(self.id, following_count=-1)
+        User.adjust_counts(other_user.id, followers_count=-1)
+
+        return True
+
+    def like(self, message):
+        """Like `message`. Returns False if already liked."""
+
+        if self.liked_ids_among([message.id]):
+            return False
+
+        db.session.add(Like(user_id=self.id, message_id=message.id))
+        User.adjust_counts(self.id, likes_count=1)
+
+        return True
+
+    def unlike(self, message):
+        """Unlike `message`. Returns False if it wasn't liked."""
+
+        deleted = db.session.execute(
+            delete(Like)
+            .where(Like.user_id == self.id)
+            .where(Like.message_id == message.id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        if not deleted:
+            return False
+
+        User.adjust_counts(self.id, likes_count=-1)
+
+        return True
+
+    @classmethod
+    def followed_by(cls, user_id, before=None):
+        """Select the users `user_id` follows, highest id first, leaving out
+        accounts being deleted.
+
+        `before` is an optional user id; only lower ids are selected.
+        Callers add the limit, and can select just the columns they need
+        with `with_only_columns`.
+        """
+
+        query = (select(cls)
+                 .join(Follow, Follow.user_being_followed_id == cls.id)
+                 .where(Follow.user_following_id == user_id)
+                 .where(cls.deleted_at.is_(None))
+                 .order_by(Follow.user_being_followed_id.desc()))
+
+        if before:
+            query = query.where(Follow.user_being_followed_id < before)
+
+        return query
+
+    @classmethod
+    def followers_of(cls, user_id, before=None):
+        """Select the users following `user_id`, highest id first.
+
+        Takes `before`, and leaves out accounts being deleted, like
+        `followed_by`.
+        """
+
+        query = (select(cls)
+                 .join(Follow, Follow.user_following_id == cls.id)
+                 .where(Follow.user_being_followed_id == user_id)
+                 .where(cls.deleted_at.is_(None))
+                 .order_by(Follow.user_following_id.desc()))
+
+        if before:
+            query = query.where(Follow.user_following_id < before)
+
+        return query
+
+    def following_ids_among(self, user_ids):
+        """Return the set of `user_ids` that this user is following.
+
+        Lets list pages resolve every follow button with one query:
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+            following_ids = g.user.following_ids_among([u.id for u in users])
+        """
 
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == self.id)
+            .where(Follow.user_being_followed_id.in_(user_ids))
+        ))
+
+
+# Accounts waiting to be hard-deleted. Few at any time, so a partial index
+# keeps counting them cheap.
+db.Index(
+    'ix_users_deleted_at',
+    User.deleted_at,
+    postgresql_where=User.deleted_at.isnot(None),
+    sqlite_where=User.deleted_at.isnot(None),
+)
+
+# User search indexes (see search.py). These use Postgres's pg_trgm
+# extension; other databases fall back to an in-process index.
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect='postgresql'),
+)
+
+db.Index(
+    'ix_users_username_lower_prefix',
+    func.lower(User.username).label('username_lower'),
+    postgresql_ops={'username_lower': 'text_pattern_ops'},
+).ddl_if(dialect='postgresql')
+
+for _column in ('username', 'location', 'bio'):
+    db.Index(
+        f'ix_users_{_column}_trgm',
+        getattr(User, _column),
+        postgresql_using='gin',
+        postgresql_ops={_column: 'gin_trgm_ops'},
+    ).ddl_if(dialect='postgresql')
 
 
 class Message(db.Model):
@@ -206,6 +546,194 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # A user's messages, newest first (profile pages, timeline backfill).
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            'user_id',
+            timestamp.desc(),
+            id.desc(),
+        ),
+    )
+
+    @classmethod
+    def get_active_or_404(cls, message_id):
+        """Return message `message_id`, or raise 404 if there's no such
+        message or its author's account is being deleted."""
+
+        return (cls.query
+                .join(cls.user)
+                .filter(cls.id == message_id)
+                .filter(User.deleted_at.is_(None))
+                .options(contains_eager(cls.user))
+                .first_or_404())
+
+    @classmethod
+    def newest_by(cls, user_id, before=None):
+        """Select `user_id`'s messages, newest first.
+
+        `before` is an optional (timestamp, id) key; only older messages
+        are selected. Callers add the limit, and can select just the
+        columns they need with `with_only_columns`.
+        """
+
+        query = (select(cls)
+                 .where(cls.user_id == user_id)
+                 .order_by(cls.timestamp.desc(), cls.id.desc()))
+
+        if before:
+            query = query.where(tuple_(cls.timestamp, cls.id)
+                                < tuple_(*before))
+
+        return query
+
+    @classmethod
+    def liked_by(cls, user_id, before=None):
+        """Select the messages `user_id` has liked, most recently liked
+        first.
+
+        Rows also have the like's `liked_at` time and `message_id`, which
+        are their sort key (see `pagination.like_key`). `before` is an
+        optional (liked_at, message id) key; only older likes are
+        selected.
+
+        Messages by accounts being deleted are left out. The query joins
+        each message's `user`, so callers can load it with
+        `contains_eager`.
+        """
+
+        query = (select(cls, Like.created_at.label('liked_at'),
+                        Like.message_id)
+                 .join(Like, Like.message_id == cls.id)
+                 .join(cls.user)
+                 .where(Like.user_id == user_id)
+                 .where(User.deleted_at.is_(None))
+                 .order_by(Like.created_at.desc(), Like.message_id.desc()))
+
+        if before:
+            query = query.where(tuple_(Like.created_at, Like.message_id)
+                                < tuple_(*before))
+
+        return query
+
+
+# Full-text search over message text (see search.py). Postgres keeps the
+# tsvector column in sync itself as a generated column; it isn't mapped
+# here since other databases can't create it.
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("ALTER TABLE messages ADD COLUMN search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED"
+        ).execute_if(dialect='postgresql'),
+)
+
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("CREATE INDEX ix_messages_search_vector "
+        "ON messages USING gin (search_vector)"
+        ).execute_if(dialect='postgresql'),
+)
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home page only has to read the newest entries for one user.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+
+
+class Job(db.Model):
+    """A piece of background work, run by `flask worker` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(100),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+    )
+
+    # Enqueueing a job with the key of one already queued (or recently run)
+    # does nothing.
+    idempotency_key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    # 'queued', 'done' or 'failed' (out of retries)
+    status = db.Column(
+        db.String(10),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # When the job is next due; pushed back after each failed attempt.
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,123 @@
+"""Keyset (cursor) pagination for Warbler.
+
+Lists are paged by remembering the sort key of the last row shown rather
+than by OFFSET, so every page costs the same no matter how deep the user
+scrolls. The key is handed to the client as an opaque `?before=` cursor.
+"""
+
+import base64
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from werkzeug.exceptions import BadRequest
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(*values):
+    """Pack sort key values into an opaque, URL-safe cursor string."""
+
+    values = [v.isoformat() if isinstance(v, datetime) else v
+              for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode(cursor):
+    """Unpack a cursor into its list of values, or raise BadRequest."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+    if not isinstance(values, list):
+        raise BadRequest("Invalid cursor")
+
+    return values
+
+
+def decode_message_cursor(cursor):
+    """Return (timestamp, id) from a message cursor, or None if no cursor.
+
+    Liked-message cursors, (liked_at, message id), decode the same way.
+    """
+
+    if not cursor:
+        return None
+
+    values = _decode(cursor)
+
+    try:
+        timestamp, message_id = values
+        return datetime.fromisoformat(timestamp), int(message_id)
+    except (TypeError, ValueError):
+        raise BadRequest("Invalid cursor")
+
+
+def decode_id_cursor(cursor):
+    """Return the id from an id-only cursor, or None if no cursor."""
+
+    if not cursor:
+        return None
+
+    values = _decode(cursor)
+
+    try:
+        (row_id,) = values
+        return int(row_id)
+    except (TypeError, ValueError):
+        raise BadRequest("Invalid cursor")
+
+
+def decode_rank_cursor(cursor):
+    """Return (score, id) from a ranked-results cursor, or None."""
+
+    if not cursor:
+        return None
+
+    values = _decode(cursor)
+
+    try:
+        score, row_id = values
+        return float(score), int(row_id)
+    except (TypeError, ValueError):
+        raise BadRequest("Invalid cursor")
+
+
+def make_page(rows, page_size, key):
+    """Build a Page from up to `page_size + 1` rows.
+
+    Callers fetch one extra row so we can tell whether another page exists
+    without a COUNT query. `key` returns the sort key values of a row.
+    """
+
+    items = rows[:page_size]
+
+    if len(rows) > page_size:
+        next_cursor = encode_cursor(*key(items[-1]))
+    else:
+        next_cursor = None
+
+    return Page(items, next_cursor)
+
+
+def message_key(message):
+    """Sort key for messages, newest first."""
+
+    return message.timestamp, message.id
+
+
+def like_key(row):
+    """Sort key for liked messages, most recently liked first."""
+
+    return row.liked_at, row.message_id
+
+
+def user_key(user):
+    """Sort key for users, newest first."""
+
+    return (user.id,)
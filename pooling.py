@@ -0,0 +1,157 @@
+"""Database connection pool settings and metrics for Warbler.
+
+Each process (gunicorn worker) keeps its own pool per database, so the
+most connections the app can open is
+
+    workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) * (1 + number of replicas)
+
+Size these to fit the database's connection budget. Config:
+
+- DB_POOL_SIZE: connections kept open per pool (default 5).
+- DB_MAX_OVERFLOW: extra connections allowed under load, closed when
+  returned (default 10).
+- DB_POOL_TIMEOUT: seconds to wait for a free connection before failing
+  (default 30).
+- DB_POOL_RECYCLE: seconds after which a connection is replaced, so
+  connections aren't dropped by server or proxy idle timeouts (default
+  1800; -1 never recycles).
+- DB_POOL_PRE_PING: test each connection when it's checked out, and
+  replace it if it's dead (default on).
+- DB_STATEMENT_TIMEOUT_MS: Postgres statement_timeout; 0 for none
+  (default 0).
+- DB_PGBOUNCER: set when connecting through PgBouncer in transaction
+  pooling mode. Each transaction may then run on a different server
+  connection, so no per-connection state is set up: the statement timeout
+  is applied with SET LOCAL at the start of every transaction instead.
+
+Pool numbers (connections checked out, overflow in use, checkouts, time
+spent waiting for a connection, timeouts) are served at /metrics.
+"""
+
+import threading
+import weakref
+from time import perf_counter
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+from instrumentation import metrics
+
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_POOL_RECYCLE = 1800
+
+_engines = weakref.WeakSet()
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that counts checkouts, waits and timeouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = perf_counter()
+        timed_out = False
+
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            with self.stats_lock:
+                self.wait_seconds += perf_counter() - start
+                self.checkouts += not timed_out
+                self.timeouts += timed_out
+
+
+def engine_options(config):
+    """Return SQLALCHEMY_ENGINE_OPTIONS for the pool settings in `config`."""
+
+    return {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', DEFAULT_POOL_RECYCLE),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+
+def configure_engine(engine, config):
+    """Apply the statement timeout to `engine` and report its pool."""
+
+    _engines.add(engine)
+
+    timeout = int(config.get('DB_STATEMENT_TIMEOUT_MS') or 0)
+    if not timeout or engine.dialect.name != 'postgresql':
+        return
+
+    if config.get('DB_PGBOUNCER'):
+        @event.listens_for(engine, 'begin')
+        def set_local_statement_timeout(connection):
+            connection.exec_driver_sql(
+                f"SET LOCAL statement_timeout = {timeout}")
+    else:
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            autocommit = dbapi_connection.autocommit
+            dbapi_connection.autocommit = True
+
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"SET statement_timeout = {timeout}")
+            cursor.close()
+
+            dbapi_connection.autocommit = autocommit
+
+
+def pool_metrics():
+    """Metrics collector reporting on every configured engine's pool."""
+
+    pools = sorted(
+        [({'database': engine.url.render_as_string(hide_password=True)},
+          engine.pool)
+         for engine in list(_engines)
+         if isinstance(engine.pool, InstrumentedQueuePool)],
+        key=lambda labels_pool: labels_pool[0]['database'])
+
+    return [
+        ('warbler_db_pool_size', 'gauge',
+         "Connections kept open by the pool.",
+         [(labels, pool.size()) for labels, pool in pools]),
+        ('warbler_db_pool_checked_out', 'gauge',
+         "Connections currently checked out of the pool.",
+         [(labels, pool.checkedout()) for labels, pool in pools]),
+        ('warbler_db_pool_overflow', 'gauge',
+         "Overflow connections currently open.",
+         [(labels, max(0, pool.overflow())) for labels, pool in pools]),
+        ('warbler_db_pool_checkouts_total', 'counter',
+         "Connections checked out of the pool.",
+         [(labels, pool.checkouts) for labels, pool in pools]),
+        ('warbler_db_pool_wait_seconds_total', 'counter',
+         "Time spent waiting for a connection, including connecting.",
+         [(labels, pool.wait_seconds) for labels, pool in pools]),
+        ('warbler_db_pool_timeouts_total', 'counter',
+         "Checkouts that gave up waiting after DB_POOL_TIMEOUT.",
+         [(labels, pool.timeouts) for labels, pool in pools]),
+    ]
+
+
+def init_app(app, engines):
+    """Configure `engines` (the app's own) and serve pool metrics.
+
+    Call after connecting the database; SQLALCHEMY_ENGINE_OPTIONS should
+    already be set from `engine_options`.
+    """
+
+    for engine in engines:
+        configure_engine(engine, app.config)
+
+    if pool_metrics not in metrics.collectors:
+        metrics.add_collector(pool_metrics)
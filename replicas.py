@@ -0,0 +1,127 @@
+"""Read-replica routing for Warbler.
+
+Views marked with `@read_only` run their queries against a replica, picked
+at random from DATABASE_REPLICA_URLS for each request. Everything else,
+and every write, goes to the primary (SQLALCHEMY_DATABASE_URI).
+
+Replicas lag the primary a little. So that users see their own changes,
+any request that may have written something (anything but GET, HEAD or
+OPTIONS) pins that user's session to the primary for
+READ_YOUR_WRITES_SECONDS (default 5).
+
+Config (read on each request):
+
+- DATABASE_REPLICA_URLS: list of replica database URLs; empty disables
+  routing.
+- READ_YOUR_WRITES_SECONDS: how long to read from the primary after a
+  write.
+"""
+
+import random
+import threading
+from time import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+
+import pooling
+
+DEFAULT_READ_YOUR_WRITES_SECONDS = 5
+PRIMARY_UNTIL_KEY = 'primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def read_only(view):
+    """Mark `view` as safe to serve from a replica.
+
+    Goes under the route decorator:
+
+        @app.get('/users')
+        @read_only
+        def list_users():
+    """
+
+    view.read_only = True
+    return view
+
+
+def get_engine(url):
+    """Return the engine for replica `url`, creating it on first use."""
+
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = create_engine(
+                url, **current_app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+            pooling.configure_engine(_engines[url], current_app.config)
+
+        return _engines[url]
+
+
+def choose_replica():
+    """Return the engine this request should read from, or None for the
+    primary."""
+
+    urls = current_app.config.get('DATABASE_REPLICA_URLS')
+    if not urls or request.method not in SAFE_METHODS:
+        return None
+
+    view = current_app.view_functions.get(request.endpoint)
+    if not getattr(view, 'read_only', False):
+        return None
+
+    if session.get(PRIMARY_UNTIL_KEY, 0) > time():
+        return None
+
+    return get_engine(random.choice(urls))
+
+
+class RoutingSession(Session):
+    """Session that sends a read-only request's reads to its replica.
+
+    Flushes and INSERT/UPDATE/DELETE statements always use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None
+                and not self._flushing
+                and not getattr(clause, 'is_dml', False)
+                and has_request_context()):
+            replica = g.get('db_replica')
+
+            if replica is not None:
+                return replica
+
+        return super().get_bind(
+            mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_app(app):
+    """Route reads for `app`'s requests. Call before other request hooks."""
+
+    @app.before_request
+    def route_reads():
+        g.db_replica = choose_replica()
+
+    @app.after_request
+    def pin_writers_to_primary(response):
+        if request.method not in SAFE_METHODS:
+            window = app.config.get(
+                'READ_YOUR_WRITES_SECONDS', DEFAULT_READ_YOUR_WRITES_SECONDS)
+            session[PRIMARY_UNTIL_KEY] = time() + window
+
+        return response
+
+    @app.teardown_request
+    def stop_routing(exc):
+        g.pop('db_replica', None)
+
+        # connect_db leaves an app context pushed for good, and requests
+        # share it, so Flask-SQLAlchemy never removes the session on its
+        # own. End its transaction here: that gives back its connections
+        # and expires anything it loaded (maybe from a replica), so the
+        # next request doesn't carry on with either.
+        app.extensions['sqlalchemy'].session.rollback()
@@ -0,0 +1,393 @@
+"""User and message search for Warbler.
+
+`LIKE '%term%'` can't use a B-tree index, so searching users used to scan
+the whole table. Searches now run in up to three steps, each backed by an
+index and capped at `limit` rows:
+
+1. exact username match (case-insensitive),
+2. username prefix match, using an index on lower(username),
+3. substring match on username (plus location/bio if configured), using
+   pg_trgm GIN indexes, ranked by trigram similarity.
+
+Results are ranked in that order. The substring step runs under a
+statement timeout (USER_SEARCH_TIMEOUT_MS); if it's cancelled, the exact
+and prefix results are returned on their own.
+
+pg_trgm is Postgres-only. On other databases (SQLite test runs), search
+uses an in-process trigram index instead.
+
+Message search uses Postgres full-text search: a generated tsvector
+column with a GIN index, ranked by relevance with a boost for newer
+messages, and paged by cursor. Other databases fall back to a LIKE scan.
+"""
+
+import threading
+from collections import defaultdict
+
+from flask import current_app
+from sqlalchemy import (
+    Float, cast, event, func, literal_column, or_, select, text, tuple_)
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import contains_eager
+
+from models import db, Message, User
+from pagination import Page, make_page
+
+DEFAULT_LIMIT = 48
+DEFAULT_FIELDS = ('username',)
+DEFAULT_TIMEOUT_MS = 500
+SEARCHABLE_FIELDS = ('username', 'location', 'bio')
+
+# pg_trgm can't use its index for substrings shorter than one trigram.
+MIN_TRIGRAM_LENGTH = 3
+
+# A message this many seconds newer than another gets this much more
+# score, on top of its text relevance (ts_rank_cd, roughly 0 to 1).
+RECENCY_SECONDS = 30 * 24 * 60 * 60
+RECENCY_WEIGHT = 0.1
+
+search_vector = literal_column('messages.search_vector', type_=TSVECTOR)
+
+
+def _dialect_name():
+    """Name of the database dialect that searches run against."""
+
+    return db.session.get_bind(mapper=User.__mapper__).dialect.name
+
+
+def search_users(term, limit=DEFAULT_LIMIT, fields=None):
+    """Return up to `limit` users matching `term`, best matches first.
+
+    `fields` are the columns to search for substrings; the default comes
+    from USER_SEARCH_FIELDS (username only). Exact and prefix matches are
+    always on username.
+    """
+
+    term = term.strip()
+    if not term:
+        return []
+
+    if fields is None:
+        fields = current_app.config.get('USER_SEARCH_FIELDS', DEFAULT_FIELDS)
+
+    if _dialect_name() == 'postgresql':
+        user_ids = _search_postgres(term, limit, fields)
+    else:
+        user_ids = fallback_index.search(term, limit, fields)
+
+    if not user_ids:
+        return []
+
+    by_id = {
+        u.id: u
+        for u in User.query.filter(User.id.in_(user_ids),
+                                   User.deleted_at.is_(None))
+    }
+
+    # The fallback index may be slightly stale, so re-check each match.
+    lowered = term.lower()
+    return [
+        by_id[user_id] for user_id in user_ids
+        if user_id in by_id and any(
+            lowered in (getattr(by_id[user_id], field) or '').lower()
+            for field in fields)
+    ]
+
+
+def _escape_like(term):
+    """Escape LIKE wildcards in user input."""
+
+    return (term
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _search_postgres(term, limit, fields):
+    """Return ranked ids of matching users, using Postgres indexes."""
+
+    lowered = term.lower()
+    username_lower = func.lower(User.username)
+
+    active = User.deleted_at.is_(None)
+
+    exact = db.session.scalars(
+        select(User.id).where(username_lower == lowered).where(active)
+    ).all()
+
+    # Shortest usernames first: they're the closest to the term
+    prefix = db.session.scalars(
+        select(User.id)
+        .where(username_lower.like(_escape_like(lowered) + '%', escape='\\'))
+        .where(active)
+        .order_by(func.length(User.username), User.username)
+        .limit(limit)
+    ).all()
+
+    user_ids = _merge(exact, prefix)
+
+    if len(user_ids) >= limit or len(term) < MIN_TRIGRAM_LENGTH:
+        return user_ids[:limit]
+
+    pattern = '%' + _escape_like(term) + '%'
+    columns = [getattr(User, field) for field in fields]
+    score = func.greatest(*[func.similarity(col, term) for col in columns])
+
+    substring = (
+        select(User.id)
+        .where(or_(*[col.ilike(pattern, escape='\\') for col in columns]))
+        .where(active)
+        .order_by(score.desc(), User.id)
+        .limit(limit)
+    )
+
+    timeout_ms = current_app.config.get(
+        'USER_SEARCH_TIMEOUT_MS', DEFAULT_TIMEOUT_MS)
+
+    return _merge(user_ids, _run_with_timeout(substring, timeout_ms))[:limit]
+
+
+def _run_with_timeout(statement, timeout_ms):
+    """Return ids from `statement`, or [] if it runs past `timeout_ms`."""
+
+    set_timeout = text("SELECT set_config('statement_timeout', :value, true)")
+
+    try:
+        with db.session.begin_nested():
+            previous = db.session.scalar(
+                text("SELECT current_setting('statement_timeout')"))
+            db.session.execute(set_timeout, {'value': f'{timeout_ms}ms'})
+
+            user_ids = db.session.scalars(statement).all()
+
+            db.session.execute(set_timeout, {'value': previous})
+    except OperationalError:
+        # Cancelled by the timeout; rolling back the savepoint also undoes
+        # the SET.
+        return []
+
+    return user_ids
+
+
+def _merge(*id_lists):
+    """Concatenate lists of ids, keeping the first occurrence of each."""
+
+    seen = set()
+    merged = []
+
+    for id_list in id_lists:
+        for user_id in id_list:
+            if user_id not in seen:
+                seen.add(user_id)
+                merged.append(user_id)
+
+    return merged
+
+
+##############################################################################
+# Message search
+
+
+def search_messages(term, limit, before=None):
+    """Return a Page of messages matching `term`, best matches first.
+
+    Messages by accounts being deleted are left out.
+
+    `before` is a (score, id) key from a previous page's cursor.
+    """
+
+    term = term.strip()
+    if not term:
+        return Page([], None)
+
+    if _dialect_name() == 'postgresql':
+        return _search_messages_postgres(term, limit, before)
+
+    return _search_messages_fallback(term, limit, before)
+
+
+def _search_messages_postgres(term, limit, before):
+    """Full-text search using the messages.search_vector GIN index."""
+
+    query = func.websearch_to_tsquery('english', term)
+    score = cast(
+        func.ts_rank_cd(search_vector, query)
+        + func.extract('epoch', Message.timestamp)
+        / RECENCY_SECONDS * RECENCY_WEIGHT,
+        Float,
+    )
+
+    statement = (
+        select(Message, score.label('score'))
+        .join(Message.user)
+        .where(search_vector.op('@@')(query))
+        .where(User.deleted_at.is_(None))
+        .options(contains_eager(Message.user))
+        .order_by(score.desc(), Message.id.desc())
+        .limit(limit + 1)
+    )
+    if before:
+        statement = statement.where(
+            tuple_(score, Message.id) < tuple_(*before))
+
+    page = make_page(db.session.execute(statement).all(), limit,
+                     lambda row: (row.score, row.Message.id))
+
+    return Page([row.Message for row in page.items], page.next_cursor)
+
+
+def _search_messages_fallback(term, limit, before):
+    """Newest-first substring scan for databases without full-text search."""
+
+    pattern = '%' + _escape_like(term) + '%'
+
+    query = (Message
+             .query.join(Message.user)
+             .filter(Message.text.ilike(pattern, escape='\\'))
+             .filter(User.deleted_at.is_(None))
+             .options(contains_eager(Message.user))
+             .order_by(Message.id.desc()))
+    if before:
+        query = query.filter(Message.id < before[1])
+
+    return make_page(query.limit(limit + 1).all(), limit,
+                     lambda msg: (0, msg.id))
+
+
+##############################################################################
+# In-process fallback index
+
+
+def trigrams(value):
+    """Trigrams of `value`, padded at the ends the way pg_trgm does it."""
+
+    padded = f"  {value.lower()} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def similarity(a, b):
+    """pg_trgm-style similarity of two strings, from 0 to 1."""
+
+    a, b = trigrams(a), trigrams(b)
+    return len(a & b) / len(a | b) if a | b else 0
+
+
+class TrigramIndex:
+    """In-memory trigram index of user search fields.
+
+    Built from the database on first use, then kept current by ORM events
+    on `User`. Accounts being deleted are left out. Bulk statements bypass
+    those events, so results may include users that no longer match;
+    `search_users` re-checks every match.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.built = False
+        self.postings = defaultdict(set)
+        self.values = {}
+
+    def build(self):
+        """Index every user in the database."""
+
+        rows = db.session.execute(
+            select(User.id, *[getattr(User, f) for f in SEARCHABLE_FIELDS])
+            .where(User.deleted_at.is_(None))
+        ).all()
+
+        with self.lock:
+            self.postings.clear()
+            self.values.clear()
+
+            for user_id, *values in rows:
+                self._add(user_id, dict(zip(SEARCHABLE_FIELDS, values)))
+
+            self.built = True
+
+    def _add(self, user_id, values):
+        """Index one user. Caller holds the lock."""
+
+        values = {field: (value or '').lower()
+                  for field, value in values.items()}
+        self.values[user_id] = values
+
+        for field, value in values.items():
+            for trigram in trigrams(value):
+                self.postings[field, trigram].add(user_id)
+
+    def _remove(self, user_id):
+        """Un-index one user. Caller holds the lock."""
+
+        values = self.values.pop(user_id, None)
+
+        for field, value in (values or {}).items():
+            for trigram in trigrams(value):
+                self.postings[field, trigram].discard(user_id)
+
+    def update(self, user):
+        """Re-index `user` after it was inserted or changed."""
+
+        if self.built:
+            with self.lock:
+                self._remove(user.id)
+                if user.deleted_at is None:
+                    self._add(user.id, {f: getattr(user, f)
+                                        for f in SEARCHABLE_FIELDS})
+
+    def remove(self, user):
+        """Un-index `user` after it was deleted."""
+
+        if self.built:
+            with self.lock:
+                self._remove(user.id)
+
+    def search(self, term, limit, fields):
+        """Return ranked ids of matching users."""
+
+        if not self.built:
+            self.build()
+
+        lowered = term.lower()
+        inner = {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+
+        with self.lock:
+            candidates = set()
+
+            for field in fields:
+                if inner:
+                    ids = set.intersection(
+                        *[self.postings.get((field, t), set())
+                          for t in inner])
+                else:
+                    ids = self.values.keys()
+
+                candidates.update(
+                    user_id for user_id in ids
+                    if lowered in self.values[user_id][field])
+
+            def rank(user_id):
+                username = self.values[user_id]['username']
+                return (
+                    username != lowered,
+                    not username.startswith(lowered),
+                    -max(similarity(self.values[user_id][f], lowered)
+                         for f in fields),
+                    user_id,
+                )
+
+            return sorted(candidates, key=rank)[:limit]
+
+
+fallback_index = TrigramIndex()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _index_user(mapper, connection, user):
+    fallback_index.update(user)
+
+
+@event.listens_for(User, 'after_delete')
+def _unindex_user(mapper, connection, user):
+    fallback_index.remove(user)
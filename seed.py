@@ -1,19 +1,20 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
+from flask_migrate import stamp
 from app import db
-from models import User, Message, Follow
+from models import User
+from bulk_load import load_csvs
+from timelines import rebuild_timelines
 
 db.drop_all()
 db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+# create_all() builds the latest schema, so mark it as fully migrated.
+stamp()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follow, DictReader(follows))
+load_csvs('generator')
 
+User.reconcile_counts()
 db.session.commit()
+
+rebuild_timelines()
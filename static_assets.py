@@ -0,0 +1,212 @@
+"""Fingerprinted static assets for Warbler.
+
+`flask build-assets` copies every file in static/ to static/dist/ with a
+hash of its contents in the name (style.css -> style.3f2a9c1b04de.css),
+and writes static/dist/manifest.json mapping one to the other. Templates
+link to assets with `asset_url`:
+
+    <link rel="stylesheet" href="{{ asset_url('stylesheets/style.css') }}">
+
+which gives the fingerprinted URL once the assets are built, or the
+plain /static/ URL if they aren't (as in development).
+
+A fingerprinted file never changes, so it's served with a far-future
+`immutable` Cache-Control. Text assets also get gzip (and, if the
+`brotli` package is installed, brotli) variants next to them, served to
+clients that accept them. Stylesheets' url("/static/...") references are
+rewritten to the fingerprinted files too.
+
+Build assets on every deploy. Files from earlier builds are left in
+place, so pages rendered by not-yet-restarted workers keep working.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import current_app, request, send_from_directory, url_for
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# One year, the most caches are expected to honor.
+MAX_AGE = 365 * 24 * 60 * 60
+
+# Files worth compressing; images and fonts already are.
+COMPRESSIBLE = {'.css', '.js', '.json', '.map', '.svg', '.txt', '.ico'}
+
+# Content codings we precompress, in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL = re.compile(r"""url\((['"]?)/static/([^'")?#]+)\1\)""")
+
+_manifests = {}
+
+
+def dist_dir(app):
+    """Where `app`'s fingerprinted assets live."""
+
+    return (app.config.get('ASSET_DIST_DIR')
+            or os.path.join(app.static_folder, DIST))
+
+
+def _write(path, data):
+    """Write `data` to `path`, so readers never see a partial file."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f"{path}.tmp", 'wb') as file:
+        file.write(data)
+
+    os.replace(f"{path}.tmp", path)
+
+
+def _compress(path, data):
+    """Write precompressed variants of `data` next to `path`, when they're
+    smaller."""
+
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data):
+            _write(path + suffix, compressed)
+
+
+def _rewrite_urls(css, manifest):
+    """Point a stylesheet's url("/static/...")s at fingerprinted files."""
+
+    def fingerprinted(match):
+        quote, path = match.groups()
+
+        if path not in manifest:
+            return match[0]
+
+        return f"url({quote}/static/{DIST}/{manifest[path]}{quote})"
+
+    return CSS_URL.sub(fingerprinted, css.decode('utf-8')).encode('utf-8')
+
+
+def build(static_dir, out_dir):
+    """Fingerprint every file under `static_dir` into `out_dir`.
+
+    Returns the manifest: {source path: fingerprinted path}, both relative
+    to their directories.
+    """
+
+    sources = []
+
+    for root, dirs, files in os.walk(static_dir):
+        dirs[:] = sorted(d for d in dirs
+                         if not d.startswith('.')
+                         and os.path.join(root, d) != out_dir)
+
+        for name in sorted(files):
+            if not name.startswith('.'):
+                path = os.path.relpath(os.path.join(root, name), static_dir)
+                sources.append(path.replace(os.sep, '/'))
+
+    manifest = {}
+
+    # Stylesheets last, so their url()s can point at fingerprinted files
+    for source in sorted(sources, key=lambda path: path.endswith('.css')):
+        with open(os.path.join(static_dir, source), 'rb') as file:
+            data = file.read()
+
+        if source.endswith('.css'):
+            data = _rewrite_urls(data, manifest)
+
+        stem, ext = os.path.splitext(source)
+        digest = hashlib.sha256(data).hexdigest()[:12]
+        manifest[source] = f"{stem}.{digest}{ext}"
+
+        path = os.path.join(out_dir, manifest[source])
+        _write(path, data)
+
+        if ext in COMPRESSIBLE:
+            _compress(path, data)
+
+    _write(os.path.join(out_dir, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    return manifest
+
+
+def manifest():
+    """The current app's manifest; empty if assets haven't been built."""
+
+    directory = dist_dir(current_app)
+
+    if directory not in _manifests:
+        try:
+            with open(os.path.join(directory, MANIFEST)) as file:
+                _manifests[directory] = json.load(file)
+        except FileNotFoundError:
+            _manifests[directory] = {}
+
+    return _manifests[directory]
+
+
+def asset_url(path):
+    """URL for static file `path`, fingerprinted if assets are built."""
+
+    fingerprinted = manifest().get(path)
+
+    if fingerprinted is None:
+        return url_for('static', filename=path)
+
+    return url_for('dist_static', filename=fingerprinted)
+
+
+def serve_dist(filename):
+    """Serve a fingerprinted asset, precompressed if the client accepts it.
+
+    In production a web server or CDN in front of the app should serve
+    static/dist/ with the same headers.
+    """
+
+    directory = dist_dir(current_app)
+    mimetype = mimetypes.guess_type(filename)[0]
+    encoding = None
+
+    for coding, suffix in ENCODINGS:
+        variant = safe_join(directory, filename + suffix)
+
+        if (request.accept_encodings[coding]
+                and variant and os.path.isfile(variant)):
+            encoding = coding
+            filename += suffix
+            break
+
+    response = send_from_directory(
+        directory, filename, mimetype=mimetype, max_age=MAX_AGE)
+
+    if encoding:
+        response.content_encoding = encoding
+
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+
+    return response
+
+
+def init_app(app):
+    """Serve fingerprinted assets and give templates `asset_url`."""
+
+    app.add_url_rule(
+        f"{app.static_url_path}/{DIST}/<path:filename>",
+        endpoint='dist_static',
+        view_func=serve_dist)
+    app.jinja_env.globals['asset_url'] = asset_url
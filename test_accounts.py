@@ -0,0 +1,198 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_accounts.py
+
+import os
+from unittest import TestCase
+
+from models import db, Follow, Job, Like, Message, TimelineEntry, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import accounts
+import jobs
+import timelines
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class AccountDeletionTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        # u1 and u2 follow each other and like each other's messages
+        u1.following.append(u2)
+        u2.following.append(u1)
+        messages = [Message(text=f"msg-{i}", user_id=user.id)
+                    for user in (u1, u2) for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        db.session.add_all([
+            Like(user_id=u2.id if msg.user_id == u1.id else u1.id,
+                 message_id=msg.id)
+            for msg in messages
+        ])
+        User.reconcile_counts()
+        timelines.rebuild_timelines()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['ACCOUNT_DELETE_BATCH_SIZE'] = accounts.DEFAULT_BATCH_SIZE
+
+    def test_delete_closes_account_right_away(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.location, "/signup")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertEqual(resp.status_code, 404)
+
+        # Nothing's removed until a worker gets to it
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         3)
+        self.assertFalse(User.authenticate("u1", "password"))
+
+        with app.test_client() as c:
+            html = c.get("/metrics").get_data(as_text=True)
+            self.assertIn("warbler_account_deletions_pending 1", html)
+
+    def test_deleted_users_leave_search(self):
+        accounts.delete_account(db.session.get(User, self.u1_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            html = c.get("/users?q=u1").get_data(as_text=True)
+            self.assertNotIn("@u1<", html)
+            self.assertIn("Sorry, no users found", html)
+
+            html = c.get("/users?q=u").get_data(as_text=True)
+            self.assertNotIn("@u1<", html)
+            self.assertIn("@u2<", html)
+
+    def test_deleted_users_messages_are_hidden(self):
+        accounts.delete_account(db.session.get(User, self.u1_id))
+        db.session.commit()
+
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual(
+            {msg.user_id for msg in timelines.get_home_timeline(u2)},
+            {self.u2_id})
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(
+                {m["user"]["id"] for m in resp.json["messages"]},
+                {self.u2_id})
+
+            html = c.get("/messages/search?q=msg").get_data(as_text=True)
+            self.assertNotIn("@u1<", html)
+            self.assertIn("@u2<", html)
+
+    def test_deleted_users_leave_lists(self):
+        msg_id = Message.query.filter_by(user_id=self.u1_id).first().id
+
+        accounts.delete_account(db.session.get(User, self.u1_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 404)
+
+            for page in ("following", "followers", "likes"):
+                html = c.get(f"/users/{self.u2_id}/{page}").get_data(
+                    as_text=True)
+                self.assertNotIn("@u1<", html)
+
+            resp = c.get(f"/api/v1/users/{self.u2_id}/likes")
+            self.assertEqual(resp.json["messages"], [])
+
+    def test_likes_of_deleted_users_messages(self):
+        msg_id = Message.query.filter_by(user_id=self.u1_id).first().id
+
+        accounts.delete_account(db.session.get(User, self.u1_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = c.post(f"/messages/{msg_id}/like")
+            self.assertEqual(resp.status_code, 404)
+            resp = c.post(f"/api/v1/messages/{msg_id}/like", json={})
+            self.assertEqual(resp.status_code, 404)
+            resp = c.post(f"/api/v1/messages/{msg_id}/unlike", json={})
+            self.assertEqual(resp.status_code, 404)
+
+        # A like that raced in after the likes step still comes off the
+        # liker's count when the message goes
+        jobs.run_batch()
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual(u2.likes_count, 0)
+        u2.like(db.session.get(Message, msg_id))
+        db.session.commit()
+
+        while jobs.run_batch():
+            pass
+
+        self.assertEqual(db.session.get(User, self.u2_id).likes_count, 0)
+
+    def test_hard_delete_in_batches(self):
+        app.config['ACCOUNT_DELETE_BATCH_SIZE'] = 2
+
+        accounts.delete_account(db.session.get(User, self.u1_id))
+        db.session.commit()
+
+        runs = 0
+        while jobs.run_batch():
+            runs += 1
+
+        self.assertGreater(runs, 5)
+        self.assertIsNone(db.session.get(User, self.u1_id))
+        self.assertEqual(Job.query.filter(Job.status != 'done').count(), 0)
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Follow.query.count(), 0)
+        self.assertEqual(Message.query.filter_by(user_id=self.u1_id).count(),
+                         0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 3)
+
+        u2 = db.session.get(User, self.u2_id)
+        self.assertEqual(
+            (u2.likes_count, u2.followers_count, u2.following_count),
+            (0, 0, 0))
+        self.assertEqual(u2.messages_count, 3)
@@ -0,0 +1,132 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_api_views.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import api
+import jobs
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+db.drop_all()
+db.create_all()
+
+
+class APIViewTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+
+        start = datetime(2024, 1, 1)
+        messages = [
+            Message(text=f"u2 message {i}", user_id=u2.id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(api.MESSAGES_PER_PAGE + 5)
+        ]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.newest_id = messages[-1].id
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_login_required(self):
+        with app.test_client() as c:
+            resp = c.get("/api/v1/timeline")
+
+            self.assertEqual(resp.status_code, 401)
+            self.assertIn("error", resp.json)
+
+    def test_show_user(self):
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["username"], "u2")
+        self.assertEqual(resp.json["following"], False)
+        self.assertNotIn("password", resp.json)
+        self.assertNotIn("email", resp.json)
+
+        resp = self.client.get("/api/v1/users/0")
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(resp.json["error"], "No such user.")
+
+    def test_user_messages_paginate(self):
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages")
+        page = resp.json
+
+        self.assertEqual(len(page["messages"]), api.MESSAGES_PER_PAGE)
+        self.assertEqual(page["messages"][0]["id"], self.newest_id)
+        self.assertEqual(page["messages"][0]["user"]["username"], "u2")
+        self.assertEqual(page["messages"][0]["liked"], False)
+
+        resp = self.client.get(f"/api/v1/users/{self.u2_id}/messages"
+                               f"?before={page['next_cursor']}")
+
+        self.assertEqual(len(resp.json["messages"]), 5)
+        self.assertIsNone(resp.json["next_cursor"])
+
+    def test_follow_and_timeline(self):
+        resp = self.client.post(f"/api/v1/users/{self.u2_id}/follow")
+        self.assertEqual(resp.status_code, 415)
+
+        resp = self.client.post(f"/api/v1/users/{self.u2_id}/follow",
+                                json={})
+        self.assertEqual(resp.json, {"following": True})
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+
+        # Following twice changes nothing
+        self.client.post(f"/api/v1/users/{self.u2_id}/follow", json={})
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+        # The followed user's messages are backfilled by a worker
+        jobs.run_batch()
+
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.json["messages"][0]["id"], self.newest_id)
+        self.assertEqual(len(resp.json["messages"]),
+                         api.MESSAGES_PER_PAGE + 5)
+
+        self.client.post(f"/api/v1/users/{self.u2_id}/unfollow", json={})
+        resp = self.client.get("/api/v1/timeline")
+        self.assertEqual(resp.json["messages"], [])
+
+    def test_like_unlike(self):
+        resp = self.client.post(f"/api/v1/messages/{self.newest_id}/like",
+                                json={})
+        self.assertEqual(resp.json, {"liked": True})
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+        resp = self.client.get(f"/api/v1/users/{self.u1_id}/likes")
+        self.assertEqual([m["id"] for m in resp.json["messages"]],
+                         [self.newest_id])
+        self.assertEqual(resp.json["messages"][0]["liked"], True)
+
+        self.client.post(f"/api/v1/messages/{self.newest_id}/unlike",
+                         json={})
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+        resp = self.client.get(f"/api/v1/users/{self.u1_id}/likes")
+        self.assertEqual(resp.json["messages"], [])
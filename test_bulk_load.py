@@ -0,0 +1,111 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+import csv
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follow, Like, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import bulk_load
+
+db.drop_all()
+db.create_all()
+
+
+class Interrupted(Exception):
+    pass
+
+
+class BulkLoadTestCase(TestCase):
+    def setUp(self):
+        Like.query.delete()
+        TimelineEntry.query.delete()
+        Follow.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.data_dir = tempfile.TemporaryDirectory()
+
+        self.write_csv('users', [
+            'email', 'username', 'image_url', 'password', 'bio',
+            'header_image_url', 'location',
+        ], [
+            [f'u{i}@email.com', f'u{i}', '/u.jpg', 'HASHED', '', '/h.jpg', '']
+            for i in range(1, 6)
+        ])
+        self.write_csv('messages', ['text', 'timestamp', 'user_id'], [
+            [f'msg {i}', '2023-01-01 00:00:00', i % 5 + 1]
+            for i in range(1, 12)
+        ])
+        self.write_csv(
+            'follows', ['user_being_followed_id', 'user_following_id'],
+            [[1, 2], [1, 3], [2, 1]])
+
+    def tearDown(self):
+        db.session.rollback()
+        self.data_dir.cleanup()
+
+    def write_csv(self, table, header, rows):
+        path = os.path.join(self.data_dir.name, f'{table}.csv')
+
+        with open(path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(header)
+            writer.writerows(rows)
+
+    def test_load_csvs(self):
+        stats = bulk_load.load_csvs(
+            self.data_dir.name, chunk_size=4, report=lambda line: None)
+
+        self.assertEqual(stats['users'][0], 5)
+        self.assertEqual(stats['messages'][0], 11)
+        self.assertEqual(stats['follows'][0], 3)
+        self.assertNotIn('likes', stats)
+
+        # Ids follow row order, so messages point at the right users.
+        self.assertEqual(
+            [u.username for u in User.query.order_by(User.id)],
+            ['u1', 'u2', 'u3', 'u4', 'u5'])
+        self.assertEqual(db.session.get(Message, 4).user.username, 'u5')
+        self.assertEqual(len(db.session.get(User, 1).followers), 2)
+
+    def test_load_csvs_sets_sequences(self):
+        bulk_load.load_csvs(self.data_dir.name, report=lambda line: None)
+
+        u = User.signup("new", "new@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual(u.id, 6)
+
+    def test_resume(self):
+        def interrupt(line):
+            if line.startswith('messages: 8 rows'):
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            bulk_load.load_csvs(
+                self.data_dir.name, chunk_size=4, report=interrupt)
+
+        # The second chunk was committed before the interruption.
+        self.assertEqual(Message.query.count(), 8)
+        db.session.rollback()
+
+        stats = bulk_load.load_csvs(
+            self.data_dir.name, chunk_size=4, resume=True,
+            report=lambda line: None)
+
+        self.assertEqual(stats['users'][0], 0)
+        self.assertEqual(stats['messages'][0], 3)
+        self.assertEqual(stats['follows'][0], 3)
+        self.assertEqual(
+            [m.text for m in Message.query.order_by(Message.id)],
+            [f'msg {i}' for i in range(1, 12)])
@@ -0,0 +1,158 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_jobs.py
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job, Message, TimelineEntry, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import jobs
+import timelines
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+calls = []
+
+
+@jobs.task('test.record')
+def record(payload):
+    if payload.get('fail'):
+        raise ValueError("failed on purpose")
+
+    calls.append(payload['n'])
+
+
+@jobs.task('test.record_batch', batch=True)
+def record_batch(payloads):
+    if any(payload.get('fail') for payload in payloads):
+        raise ValueError("failed on purpose")
+
+    calls.append([payload['n'] for payload in payloads])
+
+
+class JobsTestCase(TestCase):
+    def setUp(self):
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        calls.clear()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['JOB_MAX_ATTEMPTS'] = jobs.DEFAULT_MAX_ATTEMPTS
+
+    def test_run_and_idempotency_keys(self):
+        jobs.enqueue('test.record', {'n': 1}, key="one")
+        jobs.enqueue('test.record', {'n': 1}, key="one")
+        jobs.enqueue('test.record', {'n': 2})
+        db.session.commit()
+
+        self.assertEqual(jobs.run_batch(), 2)
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual(jobs.run_batch(), 0)
+
+        # Finished jobs keep their key until they're pruned
+        jobs.enqueue('test.record', {'n': 1}, key="one")
+        db.session.commit()
+        self.assertEqual(jobs.run_batch(), 0)
+
+    def test_retry_then_fail(self):
+        app.config['JOB_MAX_ATTEMPTS'] = 2
+
+        jobs.enqueue('test.record', {'n': 1, 'fail': True})
+        jobs.enqueue('test.record', {'n': 2})
+        db.session.commit()
+
+        jobs.run_batch()
+        self.assertEqual(calls, [2])
+
+        job = Job.query.filter_by(status='queued').one()
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("failed on purpose", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # Not due again until its backoff is over
+        self.assertEqual(jobs.run_batch(), 0)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        jobs.run_batch()
+
+        self.assertEqual(Job.query.get(job.id).status, 'failed')
+
+        with app.test_client() as c:
+            resp = c.get("/metrics")
+            self.assertIn('warbler_jobs_failed{kind="test.record"} 1',
+                          resp.get_data(as_text=True))
+
+    def test_batch_falls_back_to_single_jobs(self):
+        for n in range(3):
+            jobs.enqueue('test.record_batch', {'n': n})
+        db.session.commit()
+
+        jobs.run_batch()
+        self.assertEqual(calls, [[0, 1, 2]])
+
+        calls.clear()
+        jobs.enqueue('test.record_batch', {'n': 3})
+        jobs.enqueue('test.record_batch', {'n': 4, 'fail': True})
+        db.session.commit()
+
+        jobs.run_batch()
+        self.assertEqual(calls, [[3]])
+        self.assertEqual(Job.query.filter_by(status='queued').count(), 1)
+
+    def test_queue_metrics(self):
+        jobs.enqueue('test.record', {'n': 1})
+        db.session.commit()
+        Job.query.update({'run_at': datetime.utcnow() - timedelta(minutes=1)})
+        db.session.commit()
+
+        with app.test_client() as c:
+            html = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_jobs_queued{kind="test.record"} 1', html)
+        lag = next(line for line in html.splitlines()
+                   if line.startswith('warbler_jobs_lag_seconds'))
+        self.assertGreaterEqual(float(lag.split()[-1]), 60)
+
+    def test_post_fans_out_in_background(self):
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.flush()
+        u2.following.append(u1)
+        User.reconcile_counts()
+        db.session.commit()
+        u1_id = u1.id
+        u2_id = u2.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+        msg = Message.query.one()
+        u1 = User.query.get(u1_id)
+        u2 = User.query.get(u2_id)
+
+        self.assertEqual(timelines.get_home_timeline(u1), [msg])
+        self.assertEqual(timelines.get_home_timeline(u2), [])
+
+        jobs.work(once=True)
+
+        self.assertEqual(timelines.get_home_timeline(u2), [msg])
@@ -9,6 +9,9 @@ import os
 from unittest import TestCase
 
 from models import db, Message, User
+import fragments
+import http_cache
+import timelines
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -38,6 +41,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that issues more SQL statements than this, so N+1 query
+# regressions show up as test failures
+
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
@@ -122,29 +130,224 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             m2 = Message(text="m2-text", user_id=u2.id)
 
             db.session.add_all([m2])
-            db.session.flush()
+            db.session.commit()
 
 
             resp = c.post(f"/messages/{m2.id}/delete")
             self.assertEqual(len(u2.messages), 1)
             self.assertEqual(resp.status_code, 302)
 
+    def test_add_and_delete_message_counts(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+            msg = Message.query.filter_by(text="Hello").one()
+
+            u1 = User.query.get(self.u1_id)
+            self.assertEqual(u1.messages_count, 1)
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(u1.messages_count, 0)
+
+    def test_like_unlike_message(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.post(f"/messages/{self.m1_id}/like",
+                          headers={"Referer": f"/users/{self.u1_id}"})
+            self.assertEqual(resp.status_code, 302)
+
+            u2 = User.query.get(u2_id)
+            self.assertEqual(u2.liked_ids_among([self.m1_id]), {self.m1_id})
+            self.assertEqual(u2.likes_count, 1)
+
+            resp = c.get(f"/messages/{self.m1_id}")
+            self.assertIn("bi-star-fill", resp.get_data(as_text=True))
+
+            c.post(f"/messages/{self.m1_id}/like",
+                   headers={"Referer": f"/users/{self.u1_id}"})
+
+            self.assertEqual(u2.liked_ids_among([self.m1_id]), set())
+            self.assertEqual(u2.likes_count, 0)
+
+    def test_homepage_loads_authors_eagerly(self):
+        u1 = User.query.get(self.u1_id)
+
+        for i in range(20):
+            author = User.signup(f"a{i}", f"a{i}@email.com", "password", None)
+            db.session.flush()
+            u1.following.append(author)
+            db.session.flush()
+
+            msg = Message(text=f"from a{i}", user_id=author.id)
+            db.session.add(msg)
+            db.session.flush()
+            timelines.fan_out_message(msg)
+
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # One query per author would blow well past this limit
+            app.config['MAX_QUERIES_PER_REQUEST'] = 6
+            try:
+                resp = c.get("/")
+            finally:
+                app.config['MAX_QUERIES_PER_REQUEST'] = 10
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@a19", html)
+
+    def test_search_messages(self):
+        db.session.add_all([
+            Message(text="warblers sing at dawn", user_id=self.u1_id),
+            Message(text="nothing to see here", user_id=self.u1_id),
+        ])
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/messages/search?q=dawn")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warblers sing at dawn", html)
+            self.assertNotIn("nothing to see here", html)
+
+            resp = c.get("/messages/search?q=zebra")
+            self.assertIn("Sorry, no messages found",
+                          resp.get_data(as_text=True))
+
+    def test_message_cards_cached_per_message(self):
+        fragments.cache.backend.clear()
+
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn("messages-like", resp.get_data(as_text=True))
+            self.assertEqual(len(fragments.cache.backend.fragments), 1)
+
+            # The author gets the same cached card, without a like button
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            resp = c.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
 
+            self.assertIn("m1-text", html)
+            self.assertNotIn("messages-like", html)
+            self.assertEqual(len(fragments.cache.backend.fragments), 1)
 
+    def test_profile_edit_refreshes_message_cards(self):
+        fragments.cache.backend.clear()
 
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
+        new_image = "https://example.com/new-picture.png"
 
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
 
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertNotIn(new_image, resp.get_data(as_text=True))
 
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            c.post("/users/profile", data={
+                "username": "u1",
+                "password": "password",
+                "email": "u1@email.com",
+                "image_url": new_image,
+                "header_image_url": "https://example.com/header.png",
+                "location": "Oakland",
+                "bio": "New picture",
+            })
+            self.assertEqual(User.query.get(self.u1_id).profile_version, 1)
 
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
 
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn(new_image, resp.get_data(as_text=True))
 
+    def test_show_message_conditional(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        db.session.commit()
+        u2_id = u2.id
 
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
 
+            resp = c.get(f"/messages/{self.m1_id}")
+            etag, _ = resp.get_etag()
 
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
 
+            # Another viewer's page isn't the same
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            resp = c.get(f"/messages/{self.m1_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("messages-like", resp.get_data(as_text=True))
 
+            # Nor is the page after a deploy changes templates or assets
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            build_id = http_cache.build_id()
+            app.extensions['http_cache.build_id'] = "next-deploy"
+            try:
+                resp = c.get(f"/messages/{self.m1_id}",
+                             headers={"If-None-Match": f'"{etag}"'})
+                self.assertEqual(resp.status_code, 200)
+            finally:
+                app.extensions['http_cache.build_id'] = build_id
+
+    def test_show_message_checks_follow_once(self):
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u2.following.append(User.query.get(self.u1_id))
+        db.session.commit()
+        u2_id = u2.id
 
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u2_id
+
+            c.get(f"/messages/{self.m1_id}")
 
+            # The message with its author, the like and the follow
+            app.config['MAX_QUERIES_PER_REQUEST'] = 3
+            try:
+                resp = c.get(f"/messages/{self.m1_id}")
+            finally:
+                app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
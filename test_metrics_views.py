@@ -0,0 +1,157 @@
+"""Metrics View tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_metrics_views.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, exc
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from instrumentation import metrics
+from pooling import InstrumentedQueuePool
+
+app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+db.drop_all()
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MetricsViewTestCase(TestCase):
+    def setUp(self):
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        metrics.reset()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 100
+        app.config['METRICS_TOKEN'] = None
+
+    def test_metrics_per_endpoint(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/")
+            c.get("/")
+
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("# TYPE warbler_requests_total counter", text)
+            self.assertIn('warbler_requests_total{endpoint="homepage"} 2',
+                          text)
+            self.assertIn('warbler_db_queries_total{endpoint="homepage"}',
+                          text)
+            self.assertIn('warbler_render_seconds_total{endpoint="homepage"}',
+                          text)
+            self.assertIn(
+                'warbler_db_slowest_query_seconds{endpoint="homepage",'
+                'statement="SELECT', text)
+
+    def test_metrics_count_failed_requests(self):
+        limit = app.config.get('MAX_QUERIES_PER_REQUEST')
+        app.config['MAX_QUERIES_PER_REQUEST'] = 0
+        app.config['PROPAGATE_EXCEPTIONS'] = False
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            try:
+                resp = c.get("/")
+                self.assertEqual(resp.status_code, 500)
+            finally:
+                app.config['MAX_QUERIES_PER_REQUEST'] = limit
+                app.config['PROPAGATE_EXCEPTIONS'] = None
+
+            text = c.get("/metrics").get_data(as_text=True)
+
+        self.assertIn('warbler_requests_total{endpoint="homepage"} 1', text)
+        self.assertIn('warbler_request_errors_total{endpoint="homepage"} 1',
+                      text)
+
+    def test_metrics_need_token(self):
+        app.config['METRICS_TOKEN'] = "s3cret"
+
+        with app.test_client() as c:
+            resp = c.get("/metrics")
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer wrong"})
+            self.assertEqual(resp.status_code, 401)
+
+            resp = c.get("/metrics",
+                         headers={"Authorization": "Bearer s3cret"})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_metrics_only_local_without_token(self):
+        with app.test_client() as c:
+            resp = c.get("/metrics",
+                         environ_base={"REMOTE_ADDR": "203.0.113.7"})
+            self.assertEqual(resp.status_code, 403)
+
+            resp = c.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+
+    def test_slow_query_logged(self):
+        app.config['SLOW_QUERY_THRESHOLD_MS'] = 0
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with self.assertLogs('instrumentation', 'WARNING') as logs:
+                c.get(f"/users/{self.u1_id}")
+
+        self.assertIn("Slow query", logs.output[0])
+        self.assertIn("in show_user", logs.output[0])
+
+    def test_pool_metrics(self):
+        with app.test_client() as c:
+            c.get("/login")
+
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+        self.assertIn("# TYPE warbler_db_pool_checked_out gauge", text)
+        self.assertIn("warbler_db_pool_size{database=", text)
+        self.assertIn("warbler_db_pool_checkouts_total{database=", text)
+        self.assertIn("warbler_db_pool_wait_seconds_total{database=", text)
+
+    def test_pool_counts_timeouts(self):
+        with tempfile.NamedTemporaryFile(suffix='.db') as db_file:
+            engine = create_engine(
+                f"sqlite:///{db_file.name}",
+                poolclass=InstrumentedQueuePool,
+                pool_size=1,
+                max_overflow=0,
+                pool_timeout=0.01)
+
+            with engine.connect():
+                with self.assertRaises(exc.TimeoutError):
+                    engine.connect()
+
+            self.assertEqual(engine.pool.checkouts, 1)
+            self.assertEqual(engine.pool.timeouts, 1)
+            self.assertGreater(engine.pool.wait_seconds, 0)
+
+            engine.dispose()
@@ -0,0 +1,72 @@
+"""Query plan tests: hot queries should be served by an index."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import select, text
+
+from models import db, User, Message, Follow, Like
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+
+db.drop_all()
+db.create_all()
+
+
+class QueryPlanTestCase(TestCase):
+    def setUp(self):
+        if db.engine.dialect.name == 'postgresql':
+            # The test tables are tiny, so the planner would rather scan
+            # them. Make scans look expensive to see which index it'd use.
+            db.session.execute(text("SET LOCAL enable_seqscan = off"))
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def explain(self, statement):
+        """Return the query plan for `statement` as one string."""
+
+        sql = str(statement.compile(
+            dialect=db.engine.dialect,
+            compile_kwargs={'literal_binds': True}))
+
+        if db.engine.dialect.name == 'postgresql':
+            rows = db.session.execute(text(f"EXPLAIN {sql}")).all()
+            return '\n'.join(row[0] for row in rows)
+
+        rows = db.session.execute(text(f"EXPLAIN QUERY PLAN {sql}")).all()
+        return '\n'.join(row[-1] for row in rows)
+
+    def test_user_messages_use_index(self):
+        plan = self.explain(
+            select(Message)
+            .where(Message.user_id == 1)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(51))
+
+        self.assertIn('ix_messages_user_id_timestamp', plan)
+
+    def test_following_lookup_uses_index(self):
+        plan = self.explain(
+            select(Follow.user_being_followed_id)
+            .where(Follow.user_following_id == 1))
+
+        self.assertIn('ix_follows_user_following_id', plan)
+
+    def test_likes_lookup_uses_index(self):
+        plan = self.explain(
+            select(Like.message_id)
+            .where(Like.user_id == 1))
+
+        self.assertIn('ix_likes_user_id_message_id', plan)
+
+    def test_likes_page_uses_index(self):
+        plan = self.explain(Message.liked_by(1).limit(20))
+
+        self.assertIn('ix_likes_user_id_created_at', plan)
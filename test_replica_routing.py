@@ -0,0 +1,131 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_replica_routing.py
+
+import os
+import tempfile
+from time import time
+from unittest import TestCase
+
+from sqlalchemy import create_engine, insert, select
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+import replicas
+import user_cache
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+db.drop_all()
+db.create_all()
+
+
+class ReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        db.session.commit()
+        self.u1_id = u1.id
+
+        user_cache.cache.clear()
+
+        # A SQLite file stands in for the replica. It has everything the
+        # primary has, plus a user the primary doesn't.
+        self.replica_file = tempfile.NamedTemporaryFile(suffix='.db')
+        replica_url = f"sqlite:///{self.replica_file.name}"
+        replica = create_engine(replica_url)
+        db.metadata.create_all(replica)
+
+        rows = db.session.execute(select(User.__table__)).mappings().all()
+        with replica.begin() as connection:
+            connection.execute(insert(User.__table__), [dict(r) for r in rows])
+            connection.execute(insert(User.__table__), dict(
+                email="replica@email.com",
+                username="replica-only",
+                image_url="/u.jpg",
+                header_image_url="/h.jpg",
+                bio="",
+                location="",
+                password="HASHED",
+            ))
+        replica.dispose()
+
+        app.config['DATABASE_REPLICA_URLS'] = [replica_url]
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['DATABASE_REPLICA_URLS'] = []
+
+        for engine in replicas._engines.values():
+            engine.dispose()
+        replicas._engines.clear()
+
+        self.replica_file.close()
+
+    def test_read_only_view_uses_replica(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users")
+
+            self.assertIn("@replica-only", resp.get_data(as_text=True))
+
+    def test_no_replicas_uses_primary(self):
+        app.config['DATABASE_REPLICA_URLS'] = []
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users")
+
+            self.assertNotIn("@replica-only", resp.get_data(as_text=True))
+
+    def test_writes_use_primary_then_read_your_writes(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+            self.assertEqual(Message.query.count(), 1)
+
+            # Right after a write, reads stay on the primary...
+            resp = c.get("/users")
+            self.assertNotIn("@replica-only", resp.get_data(as_text=True))
+
+            # ...until the window closes.
+            with c.session_transaction() as sess:
+                sess[replicas.PRIMARY_UNTIL_KEY] = time() - 1
+
+            resp = c.get("/users")
+            self.assertIn("@replica-only", resp.get_data(as_text=True))
+
+    def test_no_routing_outside_requests(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/users")
+
+        self.assertIsNone(User.query.filter_by(username="replica-only").first())
+
+    def test_session_ends_with_request(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get("/users")
+
+        self.assertFalse(db.session().in_transaction())
+        for engine in replicas._engines.values():
+            self.assertEqual(engine.pool.checkedout(), 0)
@@ -0,0 +1,86 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    FLASK_DEBUG=False python -m unittest test_static_assets.py
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import static_assets
+
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+
+class StaticAssetsTestCase(TestCase):
+    def setUp(self):
+        self.static_dir = tempfile.TemporaryDirectory()
+        self.dist_dir = os.path.join(self.static_dir.name, 'dist')
+
+        os.makedirs(os.path.join(self.static_dir.name, 'images'))
+        with open(os.path.join(self.static_dir.name, 'images/bg.png'),
+                  'wb') as file:
+            file.write(b"not really a png")
+        with open(os.path.join(self.static_dir.name, 'style.css'),
+                  'w') as file:
+            file.write('body { background: url("/static/images/bg.png"); }\n'
+                       * 20)
+
+        self.manifest = static_assets.build(
+            self.static_dir.name, self.dist_dir)
+        app.config['ASSET_DIST_DIR'] = self.dist_dir
+
+    def tearDown(self):
+        app.config.pop('ASSET_DIST_DIR')
+        self.static_dir.cleanup()
+
+    def test_build(self):
+        self.assertRegex(self.manifest['style.css'], r'^style\.\w{12}\.css$')
+        self.assertRegex(self.manifest['images/bg.png'],
+                         r'^images/bg\.\w{12}\.png$')
+
+        # The stylesheet points at the fingerprinted image
+        css_path = os.path.join(self.dist_dir, self.manifest['style.css'])
+        with open(css_path) as file:
+            css = file.read()
+        self.assertIn(f"/static/dist/{self.manifest['images/bg.png']}", css)
+
+        self.assertTrue(os.path.exists(css_path + '.gz'))
+        self.assertFalse(os.path.exists(os.path.join(
+            self.dist_dir, self.manifest['images/bg.png'] + '.gz')))
+
+        # Rebuilding unchanged files gives the same names
+        self.assertEqual(
+            static_assets.build(self.static_dir.name, self.dist_dir),
+            self.manifest)
+
+    def test_serve(self):
+        with app.test_request_context():
+            url = static_assets.asset_url('style.css')
+            self.assertEqual(
+                url, f"/static/dist/{self.manifest['style.css']}")
+            self.assertEqual(static_assets.asset_url('missing.js'),
+                             "/static/missing.js")
+
+        with app.test_client() as c:
+            resp = c.get(url, headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_encoding, "gzip")
+            self.assertEqual(resp.mimetype, "text/css")
+            self.assertIn("Accept-Encoding", resp.vary)
+            self.assertTrue(resp.cache_control.immutable)
+            self.assertEqual(resp.cache_control.max_age,
+                             static_assets.MAX_AGE)
+            self.assertIn(b"background", gzip.decompress(resp.get_data()))
+            resp.close()
+
+            resp = c.get(url)
+            self.assertIsNone(resp.content_encoding)
+            self.assertIn(b"background", resp.get_data())
+            resp.close()
@@ -0,0 +1,149 @@
+"""Timeline model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline_model.py
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import timelines
+
+db.drop_all()
+db.create_all()
+
+
+class TimelineModelTestCase(TestCase):
+    def setUp(self):
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User.signup("u1", "u1@email.com", "password", None)
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        u3 = User.signup("u3", "u3@email.com", "password", None)
+        db.session.flush()
+
+        u2.following.append(u1)
+        User.reconcile_counts()
+        db.session.commit()
+
+        self.u1_id = u1.id
+        self.u2_id = u2.id
+        self.u3_id = u3.id
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 10000
+        app.config['TIMELINE_MAX_ENTRIES'] = timelines.DEFAULT_MAX_ENTRIES
+        app.config['TIMELINE_TRIM_INTERVAL'] = timelines.DEFAULT_TRIM_INTERVAL
+
+    def post(self, user_id, text):
+        msg = Message(text=text, user_id=user_id)
+        db.session.add(msg)
+        db.session.flush()
+        timelines.fan_out_message(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out_to_author_and_followers(self):
+        msg = self.post(self.u1_id, "hello")
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.query.get(self.u3_id)
+
+        self.assertEqual(timelines.get_home_timeline(u1), [msg])
+        self.assertEqual(timelines.get_home_timeline(u2), [msg])
+        self.assertEqual(timelines.get_home_timeline(u3), [])
+
+    def test_remove_message(self):
+        msg = self.post(self.u1_id, "hello")
+
+        timelines.remove_message(msg.id)
+        db.session.commit()
+
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+    def test_follow_backfills_and_unfollow_prunes(self):
+        msg = self.post(self.u1_id, "hello")
+        u3 = User.query.get(self.u3_id)
+
+        timelines.add_author(self.u3_id, self.u1_id)
+        self.assertEqual(timelines.get_home_timeline(u3), [msg])
+
+        timelines.remove_author(self.u3_id, self.u1_id)
+        self.assertEqual(timelines.get_home_timeline(u3), [])
+
+    def test_celebrity_messages_are_merged_on_read(self):
+        app.config['TIMELINE_FANOUT_THRESHOLD'] = 1
+
+        older = self.post(self.u2_id, "older")
+        msg = self.post(self.u1_id, "famous")
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=msg.id).count(), 1)
+
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(timelines.get_home_timeline(u2), [msg, older])
+
+    def test_timelines_are_trimmed(self):
+        app.config['TIMELINE_MAX_ENTRIES'] = 3
+        app.config['TIMELINE_TRIM_INTERVAL'] = 1
+
+        messages = [self.post(self.u1_id, f"msg-{i}") for i in range(5)]
+        newest = messages[:-4:-1]
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(timelines.get_home_timeline(u1), newest)
+        self.assertEqual(timelines.get_home_timeline(u2), newest)
+        self.assertEqual(TimelineEntry.query.count(), 6)
+
+        # Backfilling a followed author keeps the newest entries too
+        timelines.add_author(self.u3_id, self.u1_id)
+        u3 = User.query.get(self.u3_id)
+        self.assertEqual(timelines.get_home_timeline(u3), newest)
+
+    def test_followers_are_trimmed_now_and_then(self):
+        app.config['TIMELINE_MAX_ENTRIES'] = 3
+        app.config['TIMELINE_TRIM_INTERVAL'] = 10 ** 9
+
+        messages = [self.post(self.u1_id, f"msg-{i}") for i in range(5)]
+
+        # The author's timeline is trimmed right away; followers' can wait
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id).count(), 3)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 5)
+
+        app.config['TIMELINE_TRIM_INTERVAL'] = 1
+        messages.append(self.post(self.u1_id, "msg-5"))
+
+        u2 = User.query.get(self.u2_id)
+        self.assertEqual(timelines.get_home_timeline(u2), messages[:-4:-1])
+
+    def test_rebuild_timelines_in_batches(self):
+        app.config['TIMELINE_MAX_ENTRIES'] = 3
+
+        messages = [self.post(self.u1_id, f"msg-{i}") for i in range(5)]
+        newest = messages[:-4:-1]
+        TimelineEntry.query.delete()
+        db.session.commit()
+
+        lines = []
+        timelines.rebuild_timelines(batch_size=2, report=lines.append)
+
+        self.assertEqual(len(lines), 2)
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+        u3 = User.query.get(self.u3_id)
+        self.assertEqual(timelines.get_home_timeline(u1), newest)
+        self.assertEqual(timelines.get_home_timeline(u2), newest)
+        self.assertEqual(timelines.get_home_timeline(u3), [])
+        self.assertEqual(TimelineEntry.query.count(), 6)
@@ -9,6 +9,7 @@ import os
 from unittest import TestCase
 
 from models import db, User, Message, Follow
+from hashing import Hasher, HashingBusy, hash_cost, hasher
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -113,11 +114,59 @@ class UserModelTestCase(TestCase):
         test_user = User.authenticate(u1.username, u1.password)
         self.assertFalse(test_user == u1)
 
+    def test_user_adjust_counts(self):
+        User.adjust_counts([self.u1_id, self.u2_id], followers_count=1)
+        db.session.commit()
+
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+
+    def test_user_reconcile_counts(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
+
+        u1.following.append(u2)
+        db.session.add(Message(text="m1-text", user_id=self.u1_id))
+        db.session.flush()
 
+        self.assertEqual(User.reconcile_counts(), 2)
+        self.assertEqual(u1.messages_count, 1)
+        self.assertEqual(u1.following_count, 1)
+        self.assertEqual(u2.followers_count, 1)
+        self.assertEqual(User.reconcile_counts(), 0)
 
+    def test_user_following_ids_among(self):
+        u1 = User.query.get(self.u1_id)
+        u2 = User.query.get(self.u2_id)
 
+        self.assertEqual(u1.following_ids_among([]), set())
+        self.assertEqual(u1.following_ids_among([self.u2_id]), set())
 
+        u1.following.append(u2)
 
+        self.assertEqual(
+            u1.following_ids_among([self.u1_id, self.u2_id]), {self.u2_id})
+
+    def test_user_authenticate_rehashes(self):
+        u1 = User.query.get(self.u1_id)
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            self.assertEqual(User.authenticate(u1.username, 'password'), u1)
+        finally:
+            hasher.rounds = rounds
 
+        self.assertEqual(hash_cost(u1.password), 4)
+        self.assertTrue(User.authenticate(u1.username, 'password'))
 
+    def test_hashing_busy(self):
+        busy_hasher = Hasher(rounds=4, pool_size=1, queue_size=0,
+                             queue_timeout=0)
+        busy_hasher.slots.acquire()
 
+        with self.assertRaises(HashingBusy):
+            busy_hasher.hash_password('password')
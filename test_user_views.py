@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import datetime, timedelta
 from unittest import TestCase
 
-from models import db, Message, User
+from models import db, Follow, Like, Message, User
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,6 +21,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import fragments
+import user_cache
 
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
@@ -38,9 +41,15 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that issues more SQL statements than this, so N+1 query
+# regressions show up as test failures
+
+app.config['MAX_QUERIES_PER_REQUEST'] = 10
+
 
 class UserViewTestCase(TestCase):
     def setUp(self):
+        Like.query.delete()
         User.query.delete()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
@@ -84,12 +93,217 @@ class UserViewTestCase(TestCase):
             self.assertIn("What's Happening?", html)
             self.assertEqual(resp.status_code, 200)
 
+    def test_list_users_load_more(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            resp = c.get("/users")
+            html = resp.get_data(as_text=True)
 
+            self.assertIn("@u1", html)
+            self.assertNotIn("Load more", html)
 
+    def test_show_user_paginates_messages(self):
+        db.session.add_all([
+            Message(text=f"msg-{i}", user_id=self.u1_id) for i in range(51)
+        ])
+        db.session.commit()
 
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
 
+            resp = c.get(f"/users/{self.u1_id}")
+            html = resp.get_data(as_text=True)
 
+            self.assertEqual(html.count("show_page_for_user"), 50)
+            self.assertIn("Load more", html)
 
+            cursor = html.split("before=")[1].split('"')[0]
+            resp = c.get(f"/users/{self.u1_id}?before={cursor}")
+            html = resp.get_data(as_text=True)
 
+            self.assertEqual(html.count("show_page_for_user"), 1)
+            self.assertNotIn("Load more", html)
+
+    def test_likes_page_orders_by_like_time(self):
+        fragments.cache.backend.clear()
+
+        start = datetime(2024, 1, 1)
+        messages = [
+            Message(text=f"msg-{i}", user_id=self.u2_id,
+                    timestamp=start + timedelta(minutes=i))
+            for i in range(51)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+
+        # Liked newest message first, so like order is the reverse of
+        # message order
+        db.session.add_all([
+            Like(user_id=self.u1_id, message_id=msg.id,
+                 created_at=start + timedelta(days=1, minutes=-i))
+            for i, msg in enumerate(messages)
+        ])
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u1_id}/likes")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="message-link"'), 50)
+            self.assertLess(html.index("msg-0<"), html.index("msg-1<"))
+            self.assertNotIn("msg-50<", html)
+            self.assertIn("Load more", html)
+
+            cursor = html.split("before=")[1].split('"')[0]
+            resp = c.get(f"/users/{self.u1_id}/likes?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="message-link"'), 1)
+            self.assertIn("msg-50<", html)
+            self.assertNotIn("Load more", html)
+
+    def test_followers_page_streams_in_pages(self):
+        followers = [
+            User(username=f"fan{i}", email=f"fan{i}@email.com",
+                 password="password")
+            for i in range(49)
+        ]
+        db.session.add_all(followers)
+        db.session.flush()
+        db.session.add_all([
+            Follow(user_being_followed_id=self.u2_id,
+                   user_following_id=fan.id)
+            for fan in followers
+        ])
+        db.session.add(Follow(user_being_followed_id=followers[-1].id,
+                              user_following_id=self.u1_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}/followers")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card user-card"'), 48)
+            self.assertIn("@fan48", html)
+            self.assertNotIn("@fan0<", html)
+            self.assertEqual(html.count("btn btn-primary btn-sm"), 1)
+            self.assertIn("Load more", html)
+
+            cursor = html.split("before=")[1].split('"')[0]
+            resp = c.get(f"/users/{self.u2_id}/followers?before={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count('class="card user-card"'), 1)
+            self.assertIn("@fan0<", html)
+            self.assertNotIn("Load more", html)
+
+    def test_invalid_cursor(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users?before=not-a-cursor")
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_follow_unfollow_counts(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.post(f"/users/follow/{self.u2_id}")
+
+            u1 = User.query.get(self.u1_id)
+            u2 = User.query.get(self.u2_id)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+
+    def test_current_user_cache(self):
+        user_cache.cache.clear()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            c.get(f"/users/{self.u1_id}")
+            self.assertEqual(
+                user_cache.cache.get(self.u1_id)['username'], "u1")
+
+            resp = c.get(f"/users/{self.u1_id}")
+            self.assertIn("@u1", resp.get_data(as_text=True))
+
+            c.post("/users/profile", data={
+                "username": "u1",
+                "email": "new@email.com",
+                "password": "password",
+                "location": "Oakland",
+                "bio": "Hi",
+                "header_image_url": "http://example.com/h.jpg",
+            })
+
+            self.assertIsNone(user_cache.cache.get(self.u1_id))
+            self.assertEqual(User.query.get(self.u1_id).email,
+                             "new@email.com")
+
+    def test_search_users(self):
+        User.signup("bob", "bob@email.com", "password", None)
+        User.signup("bobby", "bobby@email.com", "password", None)
+        User.signup("jimbob", "jimbob@email.com", "password", None)
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/users?q=bob")
+            html = resp.get_data(as_text=True)
+
+            self.assertLess(html.index("@bob<"), html.index("@bobby<"))
+            self.assertLess(html.index("@bobby<"), html.index("@jimbob<"))
+            self.assertNotIn("@u1<", html)
+
+            resp = c.get("/users?q=b%25")
+            self.assertIn("Sorry, no users found", resp.get_data(as_text=True))
+
+    def test_show_user_conditional(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get(f"/users/{self.u2_id}")
+            etag, _ = resp.get_etag()
+
+            self.assertTrue(resp.cache_control.private)
+            self.assertTrue(resp.cache_control.no_cache)
+            self.assertFalse(resp.cache_control.no_store)
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b"")
+
+            # Following changes what the viewer sees
+            c.post(f"/users/follow/{self.u2_id}")
+
+            resp = c.get(f"/users/{self.u2_id}",
+                         headers={"If-None-Match": f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
 
+            resp = c.get("/")
+            self.assertTrue(resp.cache_control.no_store)
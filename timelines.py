@@ -0,0 +1,397 @@
+"""Precomputed home timelines for Warbler.
+
+Every user has a list of message ids in the `timelines` table. Posting a
+message pushes it into the timelines of the author and their followers
+(fan-out on write), so building the home page is a single indexed read.
+The author's copy is written in the request; followers' copies, and the
+backfill when someone follows an author, are written by background jobs
+(see jobs.py).
+
+Authors with a very large number of followers are the exception: writing a
+row for each follower would turn one post into a write storm. Their messages
+are only written to their own timeline and are merged into their followers'
+home pages when those pages are read (fan-out on read).
+
+Each timeline keeps only its newest TIMELINE_MAX_ENTRIES entries, so the
+table grows with the number of users rather than messages times followers.
+Authors' own timelines are trimmed on every post and on backfills.
+Re-ranking every follower's timeline on every fan-out would cost as much as
+the fan-out saves, so a follower's timeline is only trimmed on about one
+delivery in TIMELINE_TRIM_INTERVAL, and can run that far over in between.
+"""
+
+from flask import current_app
+from sqlalchemy import (
+    delete, exists, func, insert, literal, select, tuple_)
+from sqlalchemy.orm import contains_eager
+
+import jobs
+from models import db, Follow, Message, TimelineEntry, User
+
+TIMELINE_LENGTH = 100
+DEFAULT_FANOUT_THRESHOLD = 10000
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TRIM_INTERVAL = 100
+DEFAULT_REBUILD_BATCH_SIZE = 1000
+
+
+def fanout_threshold():
+    """Follower count at which an author switches to fan-out on read."""
+
+    return current_app.config.get(
+        'TIMELINE_FANOUT_THRESHOLD', DEFAULT_FANOUT_THRESHOLD)
+
+
+def max_entries():
+    """How many entries each timeline keeps."""
+
+    return current_app.config.get('TIMELINE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES)
+
+
+def trim_interval():
+    """About how many deliveries a follower's timeline gets between
+    trims."""
+
+    return current_app.config.get(
+        'TIMELINE_TRIM_INTERVAL', DEFAULT_TRIM_INTERVAL)
+
+
+def trim_timelines(user_ids):
+    """Delete all but the newest `max_entries()` entries from each of
+    these users' timelines.
+
+    `user_ids` is a list of ids or a select of ids.
+    """
+
+    ranked = (
+        select(
+            TimelineEntry.user_id,
+            TimelineEntry.message_id,
+            func.row_number().over(
+                partition_by=TimelineEntry.user_id,
+                order_by=(TimelineEntry.timestamp.desc(),
+                          TimelineEntry.message_id.desc()),
+            ).label('position'),
+        )
+        .where(TimelineEntry.user_id.in_(user_ids))
+        .subquery()
+    )
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id).in_(
+            select(ranked.c.user_id, ranked.c.message_id)
+            .where(ranked.c.position > max_entries())))
+        .execution_options(synchronize_session=False)
+    )
+
+
+def is_celebrity(user_id):
+    """Does this user have too many followers to fan out on write?"""
+
+    followers_count = db.session.scalar(
+        select(User.followers_count).where(User.id == user_id))
+
+    return (followers_count or 0) >= fanout_threshold()
+
+
+def celebrity_ids_followed_by(user_id):
+    """Ids of followed authors whose messages are merged in at read time."""
+
+    return db.session.scalars(
+        select(Follow.user_being_followed_id)
+        .join(User, User.id == Follow.user_being_followed_id)
+        .where(Follow.user_following_id == user_id)
+        .where(User.followers_count >= fanout_threshold())
+    ).all()
+
+
+def _not_in_timeline(user_id, message_id):
+    """Condition that a message isn't in a user's timeline yet, so
+    deliveries can be safely repeated."""
+
+    return ~exists().where(TimelineEntry.user_id == user_id,
+                           TimelineEntry.message_id == message_id)
+
+
+def deliver_to_author(message):
+    """Put a newly created message in its author's own timeline.
+
+    The message must already be flushed so that it has an id.
+    """
+
+    db.session.execute(
+        insert(TimelineEntry).values(
+            user_id=message.user_id,
+            message_id=message.id,
+            timestamp=message.timestamp,
+        )
+    )
+    trim_timelines([message.user_id])
+
+
+def deliver_to_followers(message_ids):
+    """Push messages into their authors' followers' timelines.
+
+    Messages by authors who are fanned out on read, and messages that have
+    since been deleted, are skipped.
+    """
+
+    deliveries = (
+        select(Follow.user_following_id, Message.id, Message.timestamp)
+        .join(Message, Message.user_id == Follow.user_being_followed_id)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id.in_(message_ids))
+        .where(User.followers_count < fanout_threshold())
+    )
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            deliveries
+            .where(_not_in_timeline(Follow.user_following_id, Message.id)),
+        )
+    )
+
+    # Spread the trims over deliveries, picking followers by a cheap hash
+    # of their id and the message's
+    recipients = deliveries.with_only_columns(
+        Follow.user_following_id).distinct()
+    interval = trim_interval()
+    if interval > 1:
+        recipients = recipients.where(
+            (Follow.user_following_id + Message.id) % interval == 0)
+
+    trim_timelines(recipients)
+
+
+def fan_out_message(message):
+    """Push a newly created message into the relevant timelines.
+
+    The message must already be flushed so that it has an id.
+    """
+
+    deliver_to_author(message)
+    deliver_to_followers([message.id])
+
+
+def queue_fan_out(message):
+    """Like `fan_out_message`, but followers get the message from a
+    background job. The author sees it right away."""
+
+    deliver_to_author(message)
+    jobs.enqueue('timelines.fan_out', {'message_id': message.id},
+                 key=f"timelines.fan_out:{message.id}")
+
+
+@jobs.task('timelines.fan_out', batch=True)
+def fan_out_job(payloads):
+    """Deliver a batch of new messages to followers."""
+
+    deliver_to_followers([payload['message_id'] for payload in payloads])
+
+
+def remove_message(message_id):
+    """Prune a deleted message from every timeline it was pushed to."""
+
+    db.session.execute(
+        delete(TimelineEntry).where(TimelineEntry.message_id == message_id)
+    )
+
+
+def add_author(user_id, author_id):
+    """Backfill the recent messages of a newly followed author."""
+
+    if is_celebrity(author_id):
+        return
+
+    recent = (
+        select(Message.id, Message.timestamp)
+        .where(Message.user_id == author_id)
+        .order_by(Message.timestamp.desc())
+        .limit(TIMELINE_LENGTH)
+        .subquery()
+    )
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            select(literal(user_id), recent.c.id, recent.c.timestamp)
+            .where(_not_in_timeline(user_id, recent.c.id)),
+        )
+    )
+    trim_timelines([user_id])
+
+
+def queue_add_author(user_id, author_id):
+    """Backfill a newly followed author's messages in a background job."""
+
+    jobs.enqueue('timelines.add_author',
+                 {'user_id': user_id, 'author_id': author_id})
+
+
+@jobs.task('timelines.add_author')
+def add_author_job(payload):
+    """Backfill an author, unless they've been unfollowed since."""
+
+    still_following = db.session.scalar(
+        select(exists()
+               .where(Follow.user_following_id == payload['user_id'])
+               .where(Follow.user_being_followed_id == payload['author_id'])))
+
+    if still_following:
+        add_author(payload['user_id'], payload['author_id'])
+
+
+def remove_author(user_id, author_id):
+    """Prune an unfollowed author's messages from a user's timeline."""
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id == user_id)
+        .where(TimelineEntry.message_id.in_(
+            select(Message.id).where(Message.user_id == author_id)))
+    )
+
+
+def home_timeline_ids(user_id, limit=TIMELINE_LENGTH, before=None):
+    """Return the ids of the newest `limit` messages for a user's home page.
+
+    Reads the precomputed timeline and merges in recent messages from any
+    followed authors that are fanned out on read. `before` is an optional
+    (timestamp, message id) key; only older messages are returned.
+    """
+
+    entries_query = (
+        select(TimelineEntry.message_id, TimelineEntry.timestamp)
+        .where(TimelineEntry.user_id == user_id)
+        .order_by(TimelineEntry.timestamp.desc(),
+                  TimelineEntry.message_id.desc())
+        .limit(limit)
+    )
+    if before:
+        entries_query = entries_query.where(
+            tuple_(TimelineEntry.timestamp, TimelineEntry.message_id)
+            < tuple_(*before))
+
+    entries = db.session.execute(entries_query).all()
+
+    celebrity_ids = celebrity_ids_followed_by(user_id)
+    if celebrity_ids:
+        celebrity_query = (
+            select(Message.id, Message.timestamp)
+            .where(Message.user_id.in_(celebrity_ids))
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit)
+        )
+        if before:
+            celebrity_query = celebrity_query.where(
+                tuple_(Message.timestamp, Message.id) < tuple_(*before))
+
+        entries += db.session.execute(celebrity_query).all()
+
+    newest = sorted(set(entries), key=lambda e: (e[1], e[0]), reverse=True)
+
+    return [message_id for message_id, _ in newest[:limit]]
+
+
+def get_home_timeline(user, limit=TIMELINE_LENGTH, before=None):
+    """Return the newest `limit` messages for `user`'s home page.
+
+    See `home_timeline_ids`; messages come with their authors loaded.
+    Messages by accounts being deleted are left out.
+    """
+
+    message_ids = home_timeline_ids(user.id, limit, before)
+
+    if not message_ids:
+        return []
+
+    messages = (Message
+                .query.join(Message.user)
+                .filter(Message.id.in_(message_ids))
+                .filter(User.deleted_at.is_(None))
+                .options(contains_eager(Message.user))
+                .all())
+    by_id = {msg.id: msg for msg in messages}
+
+    return [by_id[message_id] for message_id in message_ids
+            if message_id in by_id]
+
+
+def rebuild_timelines(batch_size=DEFAULT_REBUILD_BATCH_SIZE,
+                      report=lambda line: None):
+    """Recompute every timeline from the follows and messages tables.
+
+    Used after bulk-loading data, which bypasses `fan_out_message`.
+    Counters must be up to date, see `User.reconcile_counts`.
+
+    Users are rebuilt `batch_size` ids at a time, committing after each
+    batch, and each gets only their newest `max_entries()` entries, so no
+    transaction grows with the size of the data. Progress lines are passed
+    to `report`. Rebuilding a batch replaces its users' timelines, so an
+    interrupted rebuild can simply be run again.
+    """
+
+    low, high = db.session.execute(
+        select(func.min(User.id), func.max(User.id))).one()
+
+    if low is None:
+        db.session.commit()
+        return
+
+    for start in range(low, high + 1, batch_size):
+        _rebuild_batch(start, start + batch_size)
+        db.session.commit()
+        report(f"timelines: rebuilt users {start} to "
+               f"{min(start + batch_size, high + 1) - 1} of {high}")
+
+
+def _rebuild_batch(start, stop):
+    """Rebuild the timelines of users with ids in [start, stop)."""
+
+    db.session.execute(
+        delete(TimelineEntry)
+        .where(TimelineEntry.user_id >= start)
+        .where(TimelineEntry.user_id < stop)
+    )
+
+    own = (
+        select(Message.user_id, Message.id.label('message_id'),
+               Message.timestamp)
+        .where(Message.user_id >= start)
+        .where(Message.user_id < stop)
+    )
+
+    followed = (
+        select(Follow.user_following_id, Message.id, Message.timestamp)
+        .join(Message, Message.user_id == Follow.user_being_followed_id)
+        .join(User, User.id == Follow.user_being_followed_id)
+        .where(User.followers_count < fanout_threshold())
+        .where(Follow.user_following_id >= start)
+        .where(Follow.user_following_id < stop)
+    )
+
+    candidates = own.union_all(followed).subquery()
+
+    ranked = (
+        select(
+            candidates.c.user_id,
+            candidates.c.message_id,
+            candidates.c.timestamp,
+            func.row_number().over(
+                partition_by=candidates.c.user_id,
+                order_by=(candidates.c.timestamp.desc(),
+                          candidates.c.message_id.desc()),
+            ).label('position'),
+        )
+        .subquery()
+    )
+
+    db.session.execute(
+        insert(TimelineEntry).from_select(
+            ['user_id', 'message_id', 'timestamp'],
+            select(ranked.c.user_id, ranked.c.message_id, ranked.c.timestamp)
+            .where(ranked.c.position <= max_entries()),
+        )
+    )
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""Cache of logged-in users' profile records.
+
+Every request from a logged-in user needs that user's row, mostly to
+render the nav bar. Rather than SELECT it each time, we keep a small
+TTL + LRU cache of the columns we need, keyed by user id, and rebuild the
+`User` object from it without touching the database.
+
+The cache is per process. Views that change a user's profile, or delete
+the account, must call `invalidate`; other workers see the change once
+their entry expires.
+"""
+
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from flask import g, session
+from flask.ctx import _AppCtxGlobals
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+DEFAULT_TTL = 30
+DEFAULT_SIZE = 1024
+
+# Columns kept in the cache. Anything else (the password hash, counters)
+# is loaded from the database the first time it's read.
+CACHED_COLUMNS = (
+    'id',
+    'email',
+    'username',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+    'profile_version',
+)
+
+
+class UserCache:
+    """Thread-safe LRU cache of user records that expire after `ttl` secs."""
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.records = OrderedDict()
+
+    def get(self, user_id):
+        """Return a copy of the cached record for `user_id`, or None."""
+
+        with self.lock:
+            entry = self.records.get(user_id)
+
+            if entry is None:
+                return None
+
+            expires, record = entry
+            if expires < monotonic():
+                del self.records[user_id]
+                return None
+
+            self.records.move_to_end(user_id)
+            return dict(record)
+
+    def set(self, user_id, record):
+        """Cache `record` for `user_id`, evicting the oldest if full."""
+
+        with self.lock:
+            self.records[user_id] = (monotonic() + self.ttl, dict(record))
+            self.records.move_to_end(user_id)
+
+            while len(self.records) > self.size:
+                self.records.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Drop any cached record for `user_id`."""
+
+        with self.lock:
+            self.records.pop(user_id, None)
+
+    def clear(self):
+        """Drop every cached record."""
+
+        with self.lock:
+            self.records.clear()
+
+
+cache = UserCache()
+
+
+def configure(app):
+    """Size the cache from app config and make `g.user` lazy.
+
+    Must be called before any app context is pushed.
+    """
+
+    cache.size = app.config.get('USER_CACHE_SIZE', DEFAULT_SIZE)
+    cache.ttl = app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
+
+    app.app_ctx_globals_class = RequestGlobals
+
+
+def invalidate(user_id):
+    """Forget the cached record for `user_id` after changing their row."""
+
+    cache.invalidate(user_id)
+
+
+def load_user(user_id):
+    """Return the `User` for `user_id`, from the cache when possible.
+
+    Returns None if there is no such user, or their account is being
+    deleted.
+    """
+
+    record = cache.get(user_id)
+
+    if record is None:
+        user = db.session.get(User, user_id)
+
+        if user is None or user.deleted_at is not None:
+            return None
+
+        cache.set(user_id, {col: getattr(user, col)
+                            for col in CACHED_COLUMNS})
+        return user
+
+    # Build a "clean" detached user from the record and attach it to the
+    # session without a SELECT. If the session already has this user, we
+    # get that instance back instead.
+    user = User(**record)
+    make_transient_to_detached(user)
+
+    return db.session.merge(user, load=False)
+
+
+class RequestGlobals(_AppCtxGlobals):
+    """Flask's `g`, with `g.user` loaded the first time it's used.
+
+    Endpoints that never look at `g.user` never pay for loading it.
+    """
+
+    @property
+    def user(self):
+        if '_user' not in self.__dict__:
+            user_id = self.__dict__.get('_user_id')
+            self._user = load_user(user_id) if user_id is not None else None
+
+        return self._user
+
+    @user.setter
+    def user(self, value):
+        self._user = value
+
+
+def reset_current_user(user_key):
+    """Point `g.user` at the user in `session[user_key]`, unloaded."""
+
+    g.pop('_user', None)
+    g._user_id = session.get(user_key)